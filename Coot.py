@@ -97,7 +97,9 @@ except Exception, e :
       return None
   coot_python = empty()
 
+import select
 import socket
+import time
 #socket.setdefaulttimeout(0.01)
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from xmlrpclib import ServerProxy
@@ -139,13 +141,118 @@ def coot_startup () :
 
 #--- XML-RPC server object
 class coot_xmlrpc_server (SimpleXMLRPCServer) :
+  # connections beyond the listen backlog are retried by the client after a
+  # second, keep enough room for a burst to be served in one tick
+  request_queue_size = 64
+
   def __init__ (self, addr, phenix_interface) :
     self.phenix_interface = phenix_interface
     SimpleXMLRPCServer.__init__(self, addr, logRequests=0)
+    # system.multicall runs a list of calls in one request, each call goes
+    # through _dispatch again
+    self.register_multicall_functions()
+    # requests per tick and service time, see handle_ready_requests
+    self.n_requests = 0
+    self.n_bursts = 0           # ticks with more than one request
+    self.n_backlogged = 0       # ticks that ran out of time
+    self.max_burst = 0          # most requests served in one tick
+    self.service_time = 0.0
+    self.max_service_time = 0.0
+    # ticks that run out of time are reported at most once per interval
+    self.report_interval = 10.0
+    self.last_report = 0.0
+    self.n_reported = 0
+
+  def is_ready (self) :
+    try :
+      readable = select.select([self.socket], [], [], 0)[0]
+    except (select.error, socket.error, ValueError) :
+      return False
+    return len(readable) > 0
+
+  # serve the requests that are waiting, until none are left or budget
+  # (seconds) is used up, so that a burst of requests is cleared in one tick
+  # without starving the gtk main loop
+  # only ticks that run out of time are printed, see get_stats for the rest
+  # returns the number of requests that were served
+  def handle_ready_requests (self, budget=0.1) :
+    start = time.time()
+    n = 0
+    backlogged = False
+    while self.is_ready() :
+      if (n > 0) and (time.time() - start > budget) :
+        backlogged = True
+        break
+      t = time.time()
+      self.handle_request()
+      t = time.time() - t
+      n += 1
+      self.n_requests += 1
+      self.service_time += t
+      self.max_service_time = max(self.max_service_time, t)
+    if n > 1 or backlogged :
+      self.n_bursts += 1
+      self.max_burst = max(self.max_burst, n)
+    if backlogged :
+      self.n_backlogged += 1
+      now = time.time()
+      if now - self.last_report >= self.report_interval :
+        print "xml-rpc: %d ticks ran out of time (%.0f ms) since the last " \
+          "report, more requests are waiting" % (
+          self.n_backlogged - self.n_reported, 1000 * budget)
+        sys.stdout.flush()
+        self.last_report = now
+        self.n_reported = self.n_backlogged
+    return n
+
+  # accept the connections that are waiting, up to max_connections,
+  # returns a list of (request, client_address) for serve_connection
+  def accept_ready (self, max_connections=64) :
+    connections = []
+    while (len(connections) < max_connections) and self.is_ready() :
+      try :
+        request, client_address = self.get_request()
+      except socket.error :
+        break
+      if self.verify_request(request, client_address) :
+        connections.append((request, client_address))
+      else :
+        self.shutdown_request(request)
+    if len(connections) > 1 :
+      self.n_bursts += 1
+      self.max_burst = max(self.max_burst, len(connections))
+    return connections
+
+  # serve the request of an accepted connection once its data has arrived,
+  # like handle_request does after accepting
+  def serve_connection (self, request, client_address) :
+    t = time.time()
+    try :
+      self.process_request(request, client_address)
+    except Exception :
+      self.handle_error(request, client_address)
+      self.shutdown_request(request)
+    t = time.time() - t
+    self.n_requests += 1
+    self.service_time += t
+    self.max_service_time = max(self.max_service_time, t)
+
+  def get_stats (self) :
+    mean = 0.0
+    if self.n_requests > 0 :
+      mean = self.service_time / self.n_requests
+    return { "requests" : self.n_requests,
+             "bursts" : self.n_bursts,
+             "backlogged" : self.n_backlogged,
+             "max_burst" : self.max_burst,
+             "mean_service_ms" : 1000 * mean,
+             "max_service_ms" : 1000 * self.max_service_time, }
 
   def _dispatch (self, method, params) :
     if not self.phenix_interface.enable_xmlrpc :
       return -1
+    if method in self.funcs :
+      return self.funcs[method](*params)
     result = -1
     func = None
     if hasattr(self.phenix_interface, method) :
@@ -182,6 +289,7 @@ class coot_phenix_interface (object) :
     self._probe_file = None
     self.enable_xmlrpc = True
     self.xmlrpc_server = None
+    self.xmlrpc_budget = 0.1
     self._start_model = None
     self._current_model = None
     self._current_maps = None
@@ -233,10 +341,10 @@ class coot_phenix_interface (object) :
         print str(e)
       else :
         print "xml-rpc server running on port %d" % port
-        # timeout used to be set to whatever the Phenix preferences have it as,
-        # but 250ms seems to be a universally good choice, and much shorter
-        # intervals screw up the Coot GUI (at least on Windows)
-        gobject.timeout_add(250, self.timeout_func)
+        # requests are served as soon as they arrive, the timer is only used
+        # if the socket cannot be watched
+        if not self.watch_xmlrpc_socket() :
+          self.start_xmlrpc_timer()
         if toolbar is not None :
           self._update_btn = gtk.ToggleToolButton()
           self._update_btn.set_label("Connected to PHENIX")
@@ -306,11 +414,53 @@ then click the "Run" button.""" % out_file)
   def launch_autobuild (self, *args) :
     pass # TODO
 
+  # the XML-RPC socket is watched by the gtk main loop, new connections are
+  # accepted when the socket becomes readable and each connection is served
+  # when its request data has arrived, so Coot does not wake up while idle
+  def watch_xmlrpc_socket (self) :
+    try :
+      gobject.io_add_watch(self.xmlrpc_server.fileno(),
+        gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP, self.xmlrpc_accept)
+    except Exception, e :
+      print "Cannot watch the XML-RPC socket (%s), polling instead" % \
+        to_str(e)
+      return False
+    return True
+
+  def xmlrpc_accept (self, source, condition) :
+    if condition & (gobject.IO_ERR | gobject.IO_HUP) :
+      print "Error on the XML-RPC socket, polling instead"
+      self.start_xmlrpc_timer()
+      return False
+    for request, client_address in self.xmlrpc_server.accept_ready() :
+      try :
+        gobject.io_add_watch(request.fileno(),
+          gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP, self.xmlrpc_serve,
+          request, client_address)
+      except Exception :
+        self.xmlrpc_server.serve_connection(request, client_address)
+    return True
+
+  # one request per connection, the watch is removed afterwards
+  def xmlrpc_serve (self, source, condition, request, client_address) :
+    if condition & gobject.IO_IN :
+      self.xmlrpc_server.serve_connection(request, client_address)
+    else :
+      self.xmlrpc_server.shutdown_request(request)
+    return False
+
+  def start_xmlrpc_timer (self) :
+    # timeout used to be set to whatever the Phenix preferences have it as,
+    # but 250ms seems to be a universally good choice, and much shorter
+    # intervals screw up the Coot GUI (at least on Windows)
+    gobject.timeout_add(250, self.timeout_func)
+
   # we have to handle requests to remove them from the queue, but if
   # self.enable_xmlrpc is False, they will simply be ignored.
+  # every request that is waiting is served, up to xmlrpc_budget seconds
   def timeout_func (self, *args) :
     if self.xmlrpc_server is not None :
-      self.xmlrpc_server.handle_request()
+      self.xmlrpc_server.handle_ready_requests(self.xmlrpc_budget)
     return True
 
   def reload_molprobity_gui (self, *args) :
@@ -328,6 +478,14 @@ then click the "Run" button.""" % out_file)
   def is_alive (self) :
     return True
 
+  # number of requests, the largest number of requests served in one tick,
+  # the number of ticks that could not serve every waiting request and the
+  # time spent serving requests (ms), see handle_ready_requests
+  def get_xmlrpc_stats (self) :
+    if self.xmlrpc_server is None :
+      return {}
+    return self.xmlrpc_server.get_stats()
+
   @coot_log
   def quit (self) :
     gtk.main_quit()
@@ -496,6 +654,26 @@ then click the "Run" button.""" % out_file)
     set_scrollable_map(imol1)
     return (imol1, imol2)
 
+  # replace the model and the maps of the previous tag in one request, so
+  # the viewer never shows the new model with the old maps
+  # an empty file name keeps what is already loaded
+  @coot_log
+  def load_tag (self, pdb_out, map_file, anom_maps=True) :
+    # check both files before anything is replaced
+    for file_name in [pdb_out, map_file] :
+      if file_name and not os.path.isfile(to_unicode(file_name)) :
+        print "***error: %s not found" % file_name
+        return False
+    if pdb_out and not self.update_model(pdb_out) :
+      return False
+    if map_file :
+      self.close_maps()
+      if anom_maps :
+        self.auto_load_anom_maps(map_file)
+      else :
+        self.auto_load_maps(map_file)
+    return True
+
   @coot_log
   def load_phenix_refine_temp_files (self, tmp_dir, run_name) :
     tmp_dir = to_unicode(tmp_dir)
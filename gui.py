@@ -1,133 +1,2339 @@
 import argparse
+import array
+import bisect
+import collections
+import ctypes
+import ctypes.util
+import errno
+import heapq
 import json
+import multiprocessing.pool
 import os
-import wx
+import re
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import traceback
+
+# start of the slow imports, see --profile-startup
+import_start = time.time()
+
+# only --batch works without wxPython
+try:
+  import wx
+  frame_base = wx.Frame
+except ImportError:
+  wx = None
+  frame_base = object
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir    # backport for Python 2
+  except ImportError:
+    scandir = None
+
+import numpy
 
 import matplotlib
-matplotlib.use('WXAgg')
 matplotlib.rcParams['xtick.labelsize'] = 'x-small'
 matplotlib.rcParams['ytick.labelsize'] = 'x-small'
 matplotlib.rcParams['axes.labelsize'] = 'small'
 matplotlib.rcParams['legend.fontsize'] = 'small'
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg
 
-import libtbx.load_env
-from libtbx import xmlrpc_utils
-from wxtbx import bitmaps
+# the matplotlib figures and canvases and the cctbx modules are imported
+# where they are first used, so that the window appears sooner and
+# --batch does not load the GUI modules, the matplotlib backend is chosen
+# after the command-line arguments are read
+
+# =============================================================================
+class inotify_watcher(object):
+  '''
+  Minimal ctypes wrapper around the Linux inotify API
+  Raises OSError if inotify is not available on this system
+  '''
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF = 0x00000800
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_ISDIR = 0x40000000
+  IN_CLOEXEC = 0x00080000
+  IN_NONBLOCK = 0x00000800
+
+  event_header = struct.Struct('iIII')
+
+  def __init__(self):
+    if (not sys.platform.startswith('linux')):
+      raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+    libc_name = ctypes.util.find_library('c')
+    if (libc_name is None):
+      raise OSError(errno.ENOSYS, 'C library not found')
+    self.libc = ctypes.CDLL(libc_name, use_errno=True)
+    if (not hasattr(self.libc, 'inotify_init1')):
+      raise OSError(errno.ENOSYS, 'inotify is not supported by the C library')
+    self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                            ctypes.c_uint32]
+    self.fd = self.libc.inotify_init1(self.IN_CLOEXEC | self.IN_NONBLOCK)
+    if (self.fd < 0):
+      error = ctypes.get_errno()
+      raise OSError(error, os.strerror(error))
+
+  def add_watch(self, path, mask):
+    '''
+    Watch path for the events in mask, the watch descriptor is returned
+    '''
+    if (isinstance(path, unicode)):
+      path = path.encode(sys.getfilesystemencoding())
+    wd = self.libc.inotify_add_watch(self.fd, path, mask)
+    if (wd < 0):
+      error = ctypes.get_errno()
+      raise OSError(error, os.strerror(error), path)
+    return wd
+
+  def read_events(self, timeout=None):
+    '''
+    Wait up to timeout seconds for events and return a list of
+    (watch descriptor, mask, name) tuples
+    '''
+    events = list()
+    try:
+      readable = select.select([self.fd], [], [], timeout)[0]
+    except select.error as e:
+      if (e.args[0] == errno.EINTR):
+        return events
+      raise
+    if (len(readable) == 0):
+      return events
+    try:
+      buf = os.read(self.fd, 65536)
+    except OSError as e:
+      if (e.errno in (errno.EAGAIN, errno.EINTR)):
+        return events
+      raise
+    offset = 0
+    header_size = self.event_header.size
+    while (offset + header_size <= len(buf)):
+      wd, mask, cookie, length = self.event_header.unpack_from(buf, offset)
+      offset += header_size
+      name = buf[offset:offset + length].rstrip(b'\0')
+      offset += length
+      if (len(name) > 0):
+        name = name.decode(sys.getfilesystemencoding(), 'replace')
+      else:
+        name = None
+      events.append((wd, mask, name))
+    return events
+
+  def close(self):
+    if (self.fd is not None):
+      os.close(self.fd)
+      self.fd = None
+
+# =============================================================================
+class directory_watcher(threading.Thread):
+  '''
+  Background thread that pushes inotify events into a file_manager
+  The root directories (and subdirectories down to the scan depth) are
+  watched for new tag directories and each tag directory is watched for
+  files that have finished being written
+  callback is called (from this thread) after each batch of events
+  Listing the directories to add the watches can take a while, so this is
+  done by the thread, the file_manager keeps polling until it is ready
+  '''
+  def __init__(self, files, callback=None):
+    threading.Thread.__init__(self, name='directory_watcher')
+    self.daemon = True
+    self.files = files
+    self.callback = callback
+    self.inotify = inotify_watcher()
+    self.mask = inotify_watcher.IN_CREATE | inotify_watcher.IN_MOVED_TO | \
+                inotify_watcher.IN_CLOSE_WRITE | \
+                inotify_watcher.IN_DELETE_SELF | \
+                inotify_watcher.IN_MOVE_SELF | inotify_watcher.IN_ONLYDIR
+    self.stop_event = threading.Event()
+    self.directories = dict()   # watch descriptor -> (path, level)
+
+  def watch_roots(self):
+    '''
+    Watch the root directories and tell the file_manager when they are all
+    watched, False is returned if they cannot be watched
+    '''
+    try:
+      for root in self.files.roots:
+        if (self.stop_event.is_set()):
+          return False
+        self.watch_tree(root, 0)
+    except OSError as e:
+      print('Directory watching is not available (%s), polling instead' % e)
+      self.files.stop_watching()
+      return False
+    self.files.watcher_ready(self)
+    if (self.callback is not None):
+      self.callback()
+    return True
+
+  def watch_tree(self, path, level):
+    '''
+    Watch path and its subdirectories down to the scan depth, the list of
+    watched directories is returned
+    Roots are level 0 and tag directories are levels 1 to depth + 1
+    '''
+    wd = self.inotify.add_watch(path, self.mask)
+    self.directories[wd] = (path, level)
+    watched = [path]
+    if (level <= self.files.depth):
+      for path, entry in self.files.list_subdirectories(path):
+        watched.extend(self.watch_tree(path, level + 1))
+    return watched
+
+  def run(self):
+    if (not self.watch_roots()):
+      self.inotify.close()
+      return
+    while (not self.stop_event.is_set()):
+      try:
+        events = self.inotify.read_events(timeout=0.5)
+      except (OSError, select.error, ValueError):
+        # descriptor closed or broken, let the polling scan take over
+        self.files.stop_watching()
+        break
+      changed = False
+      for wd, mask, name in events:
+        changed = self.handle_event(wd, mask, name) or changed
+        if (self.files.watcher is not self):
+          break
+      if (changed and (self.callback is not None)):
+        self.callback()
+    self.inotify.close()
+
+  def handle_event(self, wd, mask, name):
+    '''
+    Forward a single event to the file_manager, True is returned if the
+    file_manager has something new to process
+    '''
+    if (mask & inotify_watcher.IN_Q_OVERFLOW):
+      self.files.request_rescan()
+      return True
+    if (mask & inotify_watcher.IN_IGNORED):
+      self.directories.pop(wd, None)
+      return False
+    if (wd not in self.directories):
+      return False
+    path, level = self.directories[wd]
+    if (mask & (inotify_watcher.IN_DELETE_SELF |
+                inotify_watcher.IN_MOVE_SELF)):
+      if (level == 0):
+        # a root directory went away, fall back to polling
+        self.files.stop_watching()
+        return True
+      return False
+    if (name is None):
+      return False
+    if (mask & inotify_watcher.IN_ISDIR):
+      if (level > self.files.depth):
+        return False
+      try:
+        created = self.watch_tree(os.path.join(path, name), level + 1)
+      except OSError:
+        # out of watches or directory already gone, fall back to polling
+        self.files.stop_watching()
+        created = [os.path.join(path, name)]
+      for tag in created:
+        self.files.tag_created(tag)
+      return True
+    if (level > 0):
+      closed = bool(mask & (inotify_watcher.IN_CLOSE_WRITE |
+                            inotify_watcher.IN_MOVED_TO))
+      self.files.file_completed(path, name, closed=closed)
+      return True
+    return False
+
+  def stop(self):
+    self.stop_event.set()
+
+# =============================================================================
+def tag_sort_key(tag):
+  '''
+  Tags are sorted by name, then by the path of the tag directory
+  '''
+  return (os.path.basename(tag), tag)
+
+class tag_index(object):
+  '''
+  Sorted collection of complete tags with constant time membership tests
+  Tags are kept in alphanumeric order (see tag_sort_key), the modification
+  time of each tag is stored at the same position
+  '''
+  def __init__(self):
+    self.tags = list()
+    self.times = list()
+    self.sort_keys = list()
+    self.members = set()
+
+  def __len__(self):
+    return len(self.tags)
+
+  def __contains__(self, tag):
+    return (tag in self.members)
+
+  def __getitem__(self, i):
+    return self.tags[i]
+
+  def unknown(self, tags):
+    '''
+    Return the set of tags that are not in the index
+    '''
+    return set([ tag for tag in tags if (tag not in self.members) ])
+
+  def prepare(self, new_tags):
+    '''
+    Given a list of (tag, mtime) tuples, return the new tags in order for
+    publish, tags that are already present are ignored
+    '''
+    new_tags = [ (tag_sort_key(tag), tag, mtime) for tag, mtime in new_tags
+                 if (tag not in self.members) ]
+    new_tags.sort()
+    return new_tags
+
+  def publish(self, new_tags):
+    '''
+    Insert the tags from prepare
+    '''
+    if (len(new_tags) == 0):
+      return
+    for sort_key, tag, mtime in new_tags:
+      self.members.add(tag)
+    if ( (len(self.tags) == 0) or (new_tags[0][0] > self.sort_keys[-1]) ):
+      # common case, new tags sort after everything already tracked
+      self.sort_keys.extend([ item[0] for item in new_tags ])
+      self.tags.extend([ item[1] for item in new_tags ])
+      self.times.extend([ item[2] for item in new_tags ])
+    elif (len(new_tags) > 16):
+      merged = sorted(zip(self.sort_keys, self.tags, self.times) + new_tags)
+      self.sort_keys[:] = [ item[0] for item in merged ]
+      self.tags[:] = [ item[1] for item in merged ]
+      self.times[:] = [ item[2] for item in merged ]
+    else:
+      for sort_key, tag, mtime in new_tags:
+        i = bisect.bisect_left(self.sort_keys, sort_key)
+        self.sort_keys.insert(i, sort_key)
+        self.tags.insert(i, tag)
+        self.times.insert(i, mtime)
+
+# =============================================================================
+class cycle_index(object):
+  '''
+  Highest complete refinement cycle for each tag directory
+  A cycle is complete when both <tag>_NNN.pdb and <tag>_NNN.mtz exist
+  Files are added incrementally and only cycles newer than the latest
+  complete cycle are remembered, so the cost does not grow with the number
+  of cycles
+  '''
+  def __init__(self, extensions=('pdb', 'mtz')):
+    self.extensions = extensions
+    self.latest = dict()         # tag -> latest complete cycle
+    self.partial = dict()        # tag -> {cycle: set of extensions}
+
+  def parse(self, tag, filename):
+    '''
+    Return (cycle, extension) if filename is <tag>_NNN.<extension>,
+    otherwise None
+    '''
+    name = os.path.basename(tag)
+    if (not filename.startswith(name + '_')):
+      return None
+    base, dot, extension = filename[len(name) + 1:].rpartition('.')
+    if ( (extension not in self.extensions) or (not base.isdigit()) ):
+      return None
+    return int(base), extension
+
+  def add_files(self, tag, filenames):
+    '''
+    Record files in the directory for tag, True is returned if the latest
+    complete cycle changed
+    '''
+    latest = self.latest.get(tag, 0)
+    partial = self.partial.get(tag)
+    for filename in filenames:
+      parsed = self.parse(tag, filename)
+      if ( (parsed is None) or (parsed[0] <= latest) ):
+        continue
+      if (partial is None):
+        partial = self.partial[tag] = dict()
+      partial.setdefault(parsed[0], set()).add(parsed[1])
+    if (partial is None):
+      return False
+    complete = [ cycle for cycle, extensions in partial.iteritems()
+                 if (len(extensions) == len(self.extensions)) ]
+    if (len(complete) == 0):
+      return False
+    latest = max(complete)
+    self.latest[tag] = latest
+    for cycle in list(partial.keys()):
+      if (cycle <= latest):
+        del partial[cycle]
+    if (len(partial) == 0):
+      del self.partial[tag]
+    return True
+
+  def get_latest(self, tag):
+    '''
+    Return the latest complete cycle for tag, None if there is none
+    '''
+    return self.latest.get(tag)
+
+  def forget(self, tag):
+    '''
+    Drop the latest cycle for tag once it is stored elsewhere, files passed
+    to add_files afterwards have to be newer than the stored cycle
+    '''
+    self.latest.pop(tag, None)
+
+# =============================================================================
+def default_catalog_path(directory):
+  '''
+  The catalog for <parent>/<name> is <parent>/.<name>.gui_demo.sqlite
+  It is kept outside of the monitored directory so that writing to it does
+  not change the modification time of the directory
+  With multiple directories, the catalog is placed next to the first one
+  '''
+  directory = os.path.abspath(directory)
+  return os.path.join(os.path.dirname(directory),
+                      '.' + os.path.basename(directory) + '.gui_demo.sqlite')
+
+def table_one_scalars(t1):
+  '''
+  Flatten the parsed Table 1 into a dictionary of text values, the keys are
+  <section>/<label> or <section>/<label>/<sublabel>
+  '''
+  scalars = dict()
+  for section in ('Data collection', 'Refinement'):
+    for label, value in t1.get(section, dict()).iteritems():
+      key = section + '/' + label
+      if (isinstance(value, dict)):
+        for sublabel, subvalue in value.iteritems():
+          scalars[key + '/' + sublabel] = unicode(subvalue)
+      else:
+        scalars[key] = unicode(value)
+  return scalars
+
+class tag_catalog(object):
+  '''
+  On-disk index of tags for a directory, used instead of tag_index
+  Complete and incomplete tags, refinement cycles, modification times and
+  Table 1 statistics are stored so that a restart only has to check what
+  changed since the last run. Tags are read in pages, so memory use does not
+  grow with the number of tags.
+  Navigation is served from the cached pages and reads the catalog with its
+  own connection, so it does not wait for the transactions of the scan.
+  New tags are written by prepare and the pages that are cached are read
+  again, publish then shows them all at once.
+  '''
+  schema_version = 2
+
+  def __init__(self, filename, roots, page_size=256, max_pages=8):
+    self.filename = filename
+    self.roots = '\n'.join(roots)
+    self.page_size = page_size
+    self.max_pages = max_pages
+    self.pages = collections.OrderedDict()
+    self.pages_lock = threading.Lock()
+    self.generation = 0     # changes when new tags are published
+    self.lock = threading.RLock()
+    self.connection = sqlite3.connect(filename, check_same_thread=False)
+    try:
+      # keep the journal file around instead of creating one per transaction
+      self.connection.execute('PRAGMA journal_mode=PERSIST')
+      self.connection.execute('PRAGMA synchronous=NORMAL')
+      self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+      if ( (self.get_meta('schema_version') != str(self.schema_version)) or
+           (self.get_meta('roots') != self.roots) ):
+        self.reset()
+      self.connection.execute(
+        'CREATE TEMP TABLE listing (tag TEXT PRIMARY KEY)')
+      self.count = self.connection.execute(
+        'SELECT COUNT(*) FROM tags WHERE complete = 1').fetchone()[0]
+      # for reads from the main thread
+      self.read_lock = threading.Lock()
+      self.reader = sqlite3.connect(filename, check_same_thread=False)
+    except sqlite3.Error:
+      self.connection.close()
+      raise
+
+  def reset(self):
+    '''
+    Start with an empty catalog
+    '''
+    with self.connection:
+      for table in ('tags', 'statistics'):
+        self.connection.execute('DROP TABLE IF EXISTS %s' % table)
+      self.connection.execute('DELETE FROM meta')
+      self.connection.execute(
+        '''CREATE TABLE tags (tag TEXT PRIMARY KEY, name TEXT NOT NULL,
+                               complete INTEGER NOT NULL DEFAULT 0,
+                               mtime REAL, dir_mtime REAL, cycle INTEGER)''')
+      self.connection.execute(
+        'CREATE INDEX tags_complete ON tags (complete, name, tag)')
+      self.connection.execute(
+        '''CREATE TABLE statistics (tag TEXT, name TEXT, value TEXT,
+                                     PRIMARY KEY (tag, name))''')
+      self.connection.executemany(
+        'INSERT INTO meta (key, value) VALUES (?, ?)',
+        [('schema_version', str(self.schema_version)),
+         ('roots', self.roots)])
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+    with self.read_lock:
+      self.reader.close()
+
+  # ---------------------------------------------------------------------------
+  # same interface as tag_index
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, tag):
+    with self.read_lock:
+      row = self.reader.execute(
+        'SELECT 1 FROM tags WHERE tag = ? AND complete = 1', (tag,)).fetchone()
+    return (row is not None)
+
+  def __getitem__(self, i):
+    return self.get_row(i)[0]
+
+  def get_row(self, i):
+    '''
+    Return (tag, mtime) at position i in alphanumeric order (see
+    tag_sort_key)
+    '''
+    with self.pages_lock:
+      count = self.count
+      if (i < 0):
+        i += count
+      if ( (i < 0) or (i >= count) ):
+        raise IndexError('tag index out of range')
+      page_number, offset = divmod(i, self.page_size)
+      page = self.pages.pop(page_number, None)
+      if (page is not None):
+        self.pages[page_number] = page
+        return page[offset]
+      generation = self.generation
+    with self.read_lock:
+      page = self.read_page(self.reader, page_number)
+    with self.pages_lock:
+      if (generation == self.generation):
+        while (len(self.pages) >= self.max_pages):
+          self.pages.popitem(last=False)
+        self.pages[page_number] = page
+    return page[offset]
+
+  def read_page(self, connection, page_number):
+    return connection.execute(
+      '''SELECT tag, mtime FROM tags WHERE complete = 1
+         ORDER BY name, tag LIMIT ? OFFSET ?''',
+      (self.page_size, page_number * self.page_size)).fetchall()
+
+  def unknown(self, tags):
+    '''
+    Return the set of tags that are not complete in the catalog
+    '''
+    with self.lock:
+      with self.connection:
+        self.connection.execute('DELETE FROM listing')
+        self.connection.executemany(
+          'INSERT OR IGNORE INTO listing (tag) VALUES (?)',
+          [ (tag,) for tag in tags ])
+        rows = self.connection.execute(
+          '''SELECT listing.tag FROM listing LEFT JOIN tags
+             ON (tags.tag = listing.tag AND tags.complete = 1)
+             WHERE tags.tag IS NULL''').fetchall()
+        self.connection.execute('DELETE FROM listing')
+    return set([ row[0] for row in rows ])
+
+  def prepare(self, new_tags):
+    '''
+    Store a list of (tag, mtime) tuples as complete tags and read the cached
+    pages again, returns the new count and pages for publish
+    '''
+    if (len(new_tags) == 0):
+      return None
+    with self.lock:
+      with self.connection:
+        self.ensure_rows([ tag for tag, mtime in new_tags ])
+        self.connection.executemany(
+          '''UPDATE tags SET complete = 1, mtime = ?, dir_mtime = NULL
+             WHERE tag = ?''', [ (mtime, tag) for tag, mtime in new_tags ])
+      count = self.connection.execute(
+        'SELECT COUNT(*) FROM tags WHERE complete = 1').fetchone()[0]
+      with self.pages_lock:
+        page_numbers = list(self.pages.keys())
+      pages = collections.OrderedDict(
+        [ (page_number, self.read_page(self.connection, page_number))
+          for page_number in page_numbers
+          if (page_number * self.page_size < count) ])
+    return count, pages
+
+  def publish(self, update):
+    '''
+    Show the tags stored by prepare, pages that were read in the meantime
+    are dropped
+    '''
+    if (update is None):
+      return
+    with self.pages_lock:
+      self.count, self.pages = update
+      self.generation += 1
+
+  # ---------------------------------------------------------------------------
+  # persistent state for file_manager
+  def ensure_rows(self, tags):
+    self.connection.executemany(
+      'INSERT OR IGNORE INTO tags (tag, name) VALUES (?, ?)',
+      [ (tag, os.path.basename(tag)) for tag in tags ])
+
+  def get_meta(self, key):
+    with self.lock:
+      try:
+        row = self.connection.execute(
+          'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+      except sqlite3.Error:
+        return None
+    if (row is None):
+      return None
+    return row[0]
+
+  def set_meta(self, key, value):
+    with self.lock:
+      with self.connection:
+        self.connection.execute(
+          'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+          (key, value))
+
+  def get_incomplete(self):
+    '''
+    Return the negative cache of incomplete tags, tag -> directory mtime
+    '''
+    with self.lock:
+      rows = self.connection.execute(
+        'SELECT tag, dir_mtime FROM tags WHERE complete = 0').fetchall()
+    return dict(rows)
+
+  def set_incomplete(self, incomplete_tags):
+    '''
+    Store a list of (tag, directory mtime) tuples for incomplete tags
+    '''
+    if (len(incomplete_tags) == 0):
+      return
+    with self.lock:
+      with self.connection:
+        self.ensure_rows([ tag for tag, dir_mtime in incomplete_tags ])
+        self.connection.executemany(
+          'UPDATE tags SET dir_mtime = ? WHERE tag = ? AND complete = 0',
+          [ (dir_mtime, tag) for tag, dir_mtime in incomplete_tags ])
+
+  def get_cycle(self, tag):
+    with self.read_lock:
+      row = self.reader.execute(
+        'SELECT cycle FROM tags WHERE tag = ?', (tag,)).fetchone()
+    if (row is None):
+      return None
+    return row[0]
+
+  def set_cycles(self, cycles):
+    '''
+    Store a list of (tag, latest refinement cycle) tuples
+    '''
+    if (len(cycles) == 0):
+      return
+    with self.lock:
+      with self.connection:
+        self.ensure_rows([ tag for tag, cycle in cycles ])
+        self.connection.executemany(
+          'UPDATE tags SET cycle = ? WHERE tag = ?',
+          [ (cycle, tag) for tag, cycle in cycles ])
+
+  def store_statistics_batch(self, items):
+    '''
+    Store a list of (tag, Table 1 values) tuples in one transaction, the
+    values are dictionaries from table_one_scalars
+    '''
+    if (len(items) == 0):
+      return
+    with self.lock:
+      with self.connection:
+        self.connection.executemany('DELETE FROM statistics WHERE tag = ?',
+                                    [ (tag,) for tag, scalars in items ])
+        self.connection.executemany(
+          'INSERT INTO statistics (tag, name, value) VALUES (?, ?, ?)',
+          [ (tag, name, value) for tag, scalars in items
+            for name, value in scalars.iteritems() ])
+
+  def get_all_statistics(self, names):
+    '''
+    Return a dictionary of tag -> (mtime, Table 1 values) with the values for
+    names of all complete tags
+    '''
+    statistics = dict()
+    with self.lock:
+      rows = self.connection.execute(
+        '''SELECT statistics.tag, tags.mtime, statistics.name, statistics.value
+           FROM statistics JOIN tags ON statistics.tag = tags.tag
+           WHERE tags.complete = 1 AND statistics.name IN (%s)''' %
+        ', '.join(['?']*len(names)), tuple(names)).fetchall()
+    for tag, mtime, name, value in rows:
+      statistics.setdefault(tag, (mtime, dict()))[1][name] = value
+    return statistics
+
+  def get_tags_without_statistics(self):
+    '''
+    Return the complete tags that have no stored Table 1 values
+    '''
+    with self.lock:
+      rows = self.connection.execute(
+        '''SELECT tag FROM tags WHERE complete = 1 AND
+           tag NOT IN (SELECT DISTINCT tag FROM statistics)''').fetchall()
+    return [ row[0] for row in rows ]
+
+# =============================================================================
+def file_identity(path, st=None):
+  '''
+  Return (size, mtime, inode) for path or None if it cannot be read
+  Files that are rewritten or replaced get a different identity
+  st is the result of os.stat for path if it is already known
+  '''
+  if (st is None):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+  return (st.st_size, st.st_mtime, st.st_ino)
+
+def readahead(path, block_size=1024*1024):
+  '''
+  Read a file and discard the contents, so that it is in the page cache when
+  it is needed
+  '''
+  try:
+    f = open(path, 'rb')
+    while (len(f.read(block_size)) == block_size):
+      pass
+    f.close()
+  except (IOError, OSError):
+    pass
+
+class completion_checker(object):
+  '''
+  Decides whether a result file has been completely written
+  The mode sets the convention used by the program writing the results
+    stable: the size and modification time did not change between two probes
+            at least min_interval seconds apart, or the file has not been
+            modified for quiet_time seconds, or the file was closed after
+            writing (see file_closed) and has not changed since
+    marker: a marker file (marker, with {tag} replaced by the tag name) in the
+            tag directory is at least as new as the file
+    rename: files are written elsewhere and renamed into place, so a file is
+            complete as soon as it exists
+  '''
+  modes = ('stable', 'marker', 'rename')
+
+  def __init__(self, mode='stable', marker='{tag}.done', min_interval=1.0,
+               quiet_time=10.0):
+    assert (mode in self.modes)
+    self.mode = mode
+    self.marker = marker
+    self.min_interval = min_interval
+    self.quiet_time = quiet_time
+    self.lock = threading.Lock()
+    self.observations = dict()   # path -> (size, mtime, probe time)
+    self.closed = dict()         # path -> (size, mtime) when it was closed
+
+  def file_closed(self, path):
+    '''
+    Record that path was closed after writing or moved into place (an
+    inotify event), in stable mode the file is complete until it changes
+    '''
+    if (self.mode != 'stable'):
+      return
+    try:
+      st = os.stat(path)
+    except OSError:
+      return
+    with self.lock:
+      if (len(self.closed) > 100000):
+        self.closed.clear()    # files that were never probed
+      self.closed[path] = (st.st_size, st.st_mtime)
+
+  def is_complete(self, tag, filename, now=None, st=None):
+    '''
+    Return True if <tag>/<filename> has been completely written
+    st is the result of os.stat for the file if it is already known
+    '''
+    if (self.mode == 'rename'):
+      return True
+    path = os.path.join(tag, filename)
+    if (st is None):
+      try:
+        st = os.stat(path)
+      except OSError:
+        return False
+    if (self.mode == 'marker'):
+      marker = self.marker.format(tag=os.path.basename(tag))
+      try:
+        return (os.stat(os.path.join(tag, marker)).st_mtime >= st.st_mtime)
+      except OSError:
+        return False
+    if (now is None):
+      now = time.time()
+    identity = (st.st_size, st.st_mtime)
+    with self.lock:
+      if (self.closed.pop(path, None) == identity):
+        self.observations.pop(path, None)
+        return True
+      if (now - st.st_mtime > self.quiet_time):
+        self.observations.pop(path, None)
+        return True
+      previous = self.observations.get(path)
+      if ( (previous is not None) and (previous[:2] == identity) and
+           (now - previous[2] >= self.min_interval) ):
+        del self.observations[path]
+        return True
+      if ( (previous is None) or (previous[:2] != identity) ):
+        self.observations[path] = identity + (now,)
+    return False
+
+# =============================================================================
+class json_key_reader(object):
+  '''
+  Extracts the values of some keys of the top level object in a JSON file
+  The file is read in blocks and the values of the other keys are skipped
+  without being parsed or kept, so the memory used only depends on the size
+  of the values that are extracted
+  '''
+  structure = re.compile(r'["{}\[\]]')
+  string_end = re.compile(r'["\\]')
+  scalar_end = re.compile(r'[,}\]\s]')
+  # for str.translate, brackets become ( or ) and other characters are removed
+  bracket_table = ''.join([ {'{': '(', '[': '(', '}': ')', ']': ')'}.get(
+    chr(i), chr(i)) for i in xrange(256) ])
+  not_brackets = ''.join([ chr(i) for i in xrange(256)
+                           if (chr(i) not in '{}[]') ])
+
+  def __init__(self, f, block_size=64*1024):
+    self.f = f
+    self.block_size = block_size
+    self.buffer = ''
+    self.position = 0
+    self.eof = False
+    self.captured = None    # pieces of the value being extracted
+    self.capture_start = 0
+
+  def fill(self):
+    '''
+    Read the next block, the text before position is dropped unless it is
+    part of a value being extracted
+    '''
+    if (self.eof):
+      raise ValueError('Unexpected end of JSON file')
+    if (self.captured is not None):
+      self.captured.append(self.buffer[self.capture_start:self.position])
+      self.capture_start = 0
+    block = self.f.read(self.block_size)
+    if (len(block) == 0):
+      self.eof = True
+    self.buffer = self.buffer[self.position:] + block
+    self.position = 0
+
+  def peek(self):
+    '''
+    Skip whitespace and return the next character without consuming it
+    '''
+    while True:
+      while ( (self.position < len(self.buffer)) and
+              (self.buffer[self.position].isspace()) ):
+        self.position += 1
+      if (self.position < len(self.buffer)):
+        return self.buffer[self.position]
+      self.fill()
+
+  def expect(self, character):
+    if (self.peek() != character):
+      raise ValueError('Expected %s in JSON file' % character)
+    self.position += 1
+
+  def start_capture(self):
+    self.captured = list()
+    self.capture_start = self.position
+
+  def stop_capture(self):
+    self.captured.append(self.buffer[self.capture_start:self.position])
+    text = ''.join(self.captured)
+    self.captured = None
+    return text
+
+  def search(self, pattern):
+    '''
+    Return the next match of pattern starting at position, reading more of
+    the file as needed
+    '''
+    while True:
+      match = pattern.search(self.buffer, self.position)
+      if ( (match is not None) and (match.end() < len(self.buffer)) ):
+        return match
+      # keep the match for the next search, an escape needs the next character
+      if (match is not None):
+        self.position = match.start()
+      else:
+        self.position = len(self.buffer)
+      if (self.eof):
+        return match
+      self.fill()
+
+  def skip_string(self):
+    self.position += 1
+    while True:
+      match = self.search(self.string_end)
+      if (match is None):
+        raise ValueError('Unterminated string in JSON file')
+      if (match.group() == '"'):
+        self.position = match.end()
+        return
+      self.position = match.end() + 1
+
+  def skip_value(self):
+    character = self.peek()
+    if (character == '"'):
+      self.skip_string()
+    elif (character in '{['):
+      self.skip_container()
+    else:
+      match = self.search(self.scalar_end)
+      if (match is None):
+        self.position = len(self.buffer)
+      else:
+        self.position = match.start()
+
+  def skip_container(self):
+    '''
+    Skip an object or array
+    Whole blocks are skipped by counting the brackets outside of strings with
+    string methods and only the block where the value ends is scanned one
+    token at a time
+    '''
+    self.position += 1
+    depth = 1
+    in_string = False
+    escaped = False     # the first character is escaped
+    while True:
+      text = self.buffer[self.position:]
+      if (escaped):
+        text = text[1:]
+      # backslashes only appear in strings
+      stripped = text.rstrip('\\')
+      escaped_next = ((len(text) - len(stripped)) % 2 == 1)
+      if (escaped_next):
+        text = text[:-1]
+      text = text.replace('\\\\', '').replace('\\"', '')
+      pieces = text.split('"')
+      if (in_string):
+        outside = pieces[1::2]
+      else:
+        outside = pieces[0::2]
+      brackets = ''.join(outside).translate(self.bracket_table,
+                                            self.not_brackets)
+      # remove matching brackets, leaving closing brackets followed by
+      # opening brackets
+      length = -1
+      while (length != len(brackets)):
+        length = len(brackets)
+        brackets = brackets.replace('()', '')
+      closing = length - len(brackets.lstrip(')'))
+      if (closing >= depth):
+        break
+      depth += length - 2*closing
+      in_string = (in_string != (len(pieces) % 2 == 0))
+      escaped = escaped_next
+      self.position = len(self.buffer)
+      self.fill()
+    if (escaped):
+      self.position += 1
+    while True:
+      if (in_string):
+        match = self.search(self.string_end)
+        if (match is None):
+          raise ValueError('Unterminated string in JSON file')
+        if (match.group() == '"'):
+          in_string = False
+          self.position = match.end()
+        else:
+          self.position = match.end() + 1
+        continue
+      match = self.search(self.structure)
+      if (match is None):
+        raise ValueError('Unterminated value in JSON file')
+      character = match.group()
+      self.position = match.end()
+      if (character == '"'):
+        in_string = True
+      elif (character in '{['):
+        depth += 1
+      else:
+        depth -= 1
+        if (depth == 0):
+          return
+
+  def read(self, keys):
+    '''
+    Return a dictionary with the values for keys that are in the file
+    Reading stops once all keys are found
+    '''
+    values = dict()
+    self.expect('{')
+    if (self.peek() == '}'):
+      return values
+    while (len(values) < len(keys)):
+      if (self.peek() != '"'):
+        raise ValueError('Expected a key in JSON file')
+      self.start_capture()
+      self.skip_string()
+      key = json.loads(self.stop_capture())
+      self.expect(':')
+      self.peek()
+      if (key in keys):
+        self.start_capture()
+        self.skip_value()
+        values[key] = json.loads(self.stop_capture())
+      else:
+        self.skip_value()
+      if (self.peek() == '}'):
+        break
+      self.expect(',')
+    return values
+
+def load_json_keys(path, keys):
+  '''
+  Return a dictionary with the values for keys in the top level object of a
+  JSON file, the rest of the file is not parsed
+  '''
+  f = open(path, 'rb')
+  try:
+    return json_key_reader(f).read(keys)
+  finally:
+    f.close()
+
+# =============================================================================
+def read_tables(path):
+  '''
+  Read Table 1 and Table 2 from a JSON file, the other parts of the file are
+  skipped
+  '''
+  table = load_json_keys(path, ('Table 1', 'Table 2'))
+  return {'Table 1': table['Table 1'], 'Table 2': table['Table 2'],
+          'Table 2 columns': table_two_columns(table['Table 2'])}
+
+def sidecar_path(path):
+  '''
+  The binary sidecar for <tag>.json is <tag>.monitor.npz
+  '''
+  return os.path.splitext(path)[0] + '.monitor.npz'
+
+def write_sidecar(path, tables):
+  '''
+  Save Table 1 and the Table 2 columns from read_tables as a binary file
+  The file is written under a temporary name and renamed, so a partial file
+  is never read. Errors (e.g. a read-only directory) are ignored.
+  '''
+  arrays = tables['Table 2 columns'].get_arrays()
+  arrays['table_one'] = numpy.array(json.dumps(tables['Table 1']))
+  temporary = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                threading.current_thread().ident)
+  try:
+    f = open(temporary, 'wb')
+    try:
+      numpy.savez(f, **arrays)
+    finally:
+      f.close()
+    os.rename(temporary, path)
+  except (IOError, OSError):
+    try:
+      os.remove(temporary)
+    except OSError:
+      pass
+
+def read_sidecar(path):
+  '''
+  Return the statistics saved by write_sidecar, Table 2 is only available as
+  columns
+  '''
+  data = numpy.load(path, allow_pickle=False)
+  try:
+    return {'Table 1': json.loads(data['table_one'].item()), 'Table 2': None,
+            'Table 2 columns': table_two_columns.from_arrays(data)}
+  finally:
+    data.close()
+
+# =============================================================================
+class table_cache(object):
+  '''
+  Least recently used cache of the statistics read from the JSON files
+  Entries are keyed by path and checked against the identity of the file, so
+  a rewritten file is parsed again
+  The memory used by an entry is estimated from the statistics that are kept
+  (see get_size), not from the JSON file, which is mostly skipped, and the
+  least recently used entries are dropped when the total is larger than
+  max_size (bytes)
+  The statistics are read with load, read_tables by default
+  '''
+  overhead = 4    # memory for parsed JSON values relative to their text
+
+  def get_size(self, tables):
+    '''
+    Estimate the memory (bytes) used by the statistics from load
+    '''
+    size = 0
+    for key, value in tables.iteritems():
+      if (isinstance(value, table_two_columns)):
+        size += value.values.nbytes + value.valid.nbytes + value.x.nbytes
+        size += 4*sum([ len(label) for label in value.range_labels ])
+      else:
+        size += self.overhead*len(json.dumps(value))
+    return size
+
+  def __init__(self, max_size=64*1024*1024, load=None):
+    self.max_size = max_size
+    self.load = load
+    if (self.load is None):
+      self.load = read_tables
+    self.entries = collections.OrderedDict()  # path -> (identity, size, tables)
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, path):
+    '''
+    Return the statistics for path, the file is only read if it is not in
+    the cache or has changed
+    '''
+    identity = file_identity(path)
+    with self.lock:
+      entry = self.entries.pop(path, None)
+      if (entry is not None):
+        if ( (identity is not None) and (entry[0] == identity) ):
+          self.entries[path] = entry
+          self.hits += 1
+          return entry[2]
+        self.size -= entry[1]
+      self.misses += 1
+    tables = self.load(path)
+    if (identity is not None):
+      self.add(path, identity, tables)
+    return tables
+
+  def add(self, path, identity, tables):
+    size = self.get_size(tables)
+    if (size > self.max_size):
+      return
+    with self.lock:
+      entry = self.entries.pop(path, None)
+      if (entry is not None):
+        self.size -= entry[1]
+      self.entries[path] = (identity, size, tables)
+      self.size += size
+      while (self.size > self.max_size):
+        self.size -= self.entries.popitem(last=False)[1][1]
+
+  def get_status(self):
+    return 'Cache: %d hits, %d misses, %.1f MB' % \
+      (self.hits, self.misses, self.size/(1024.0*1024.0))
+
+# =============================================================================
+# Table 1 values shown as trends across tags
+# (name, key from table_one_scalars, position of the number in the text)
+trend_metrics = (
+  ('CC1/2', 'Data collection/CC1/2', 0),
+  ('Rsplit', 'Data collection/Rsplit', 0),
+  ('I/sigI', 'Data collection/I/sigI', 0),
+  ('Completeness', 'Data collection/Completeness', 0),
+  ('Rwork', 'Refinement/Rwork / Rfree', 0),
+  ('Rfree', 'Refinement/Rwork / Rfree', 1))
+number_pattern = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+def trend_value(text, position):
+  '''
+  Return the number at position in text (e.g. 0.95 (0.42) has 2 numbers) or
+  NaN if there is no such number
+  '''
+  numbers = number_pattern.findall(text)
+  if (position < len(numbers)):
+    return float(numbers[position])
+  return numpy.nan
+
+class trend_store(object):
+  '''
+  Time series of Table 1 values across tags
+  Each metric is stored in an array that is appended to, so adding a tag
+  takes constant time and does not copy the values already stored
+  revision changes when values that are already stored are replaced with
+  different values
+  '''
+  def __init__(self, metrics=trend_metrics):
+    self.metrics = metrics
+    self.names = [ name for name, key, position in metrics ]
+    self.keys = sorted(set([ key for name, key, position in metrics ]))
+    self.positions = dict()   # tag -> position in the arrays
+    self.times = array.array('d')
+    self.values = [ array.array('d') for metric in metrics ]
+    self.revision = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.times)
+
+  def __contains__(self, tag):
+    return (tag in self.positions)
+
+  def add(self, tag, mtime, scalars):
+    '''
+    Add or replace the values for tag, scalars is the output of
+    table_one_scalars, the existing time is kept if mtime is None
+    '''
+    values = [ trend_value(scalars.get(key, u''), position)
+               for name, key, position in self.metrics ]
+    with self.lock:
+      i = self.positions.get(tag)
+      if (i is None):
+        self.positions[tag] = len(self.times)
+        self.times.append(mtime)
+        for metric_values, value in zip(self.values, values):
+          metric_values.append(value)
+      else:
+        changed = False
+        if ( (mtime is not None) and (self.times[i] != mtime) ):
+          self.times[i] = mtime
+          changed = True
+        for metric_values, value in zip(self.values, values):
+          old = metric_values[i]
+          if ( (old != value) and not (numpy.isnan(old) and
+                                       numpy.isnan(value)) ):
+            metric_values[i] = value
+            changed = True
+        if (changed):
+          self.revision += 1
+
+  def update(self, tag, scalars):
+    '''
+    Replace the values for a tag that is already stored
+    '''
+    if (tag in self.positions):
+      self.add(tag, None, scalars)
+
+  def get_arrays(self, start=0):
+    '''
+    Return (revision, times, values) for the tags added since start, values
+    is a dictionary of metric name -> array
+    '''
+    with self.lock:
+      times = numpy.array(self.times[start:], dtype=numpy.float64)
+      values = dict([ (name, numpy.array(metric_values[start:],
+                                         dtype=numpy.float64))
+                      for name, metric_values in zip(self.names, self.values) ])
+      return self.revision, times, values
 
 # =============================================================================
 class file_manager(object):
   '''
-  Keeps track of files in a directory
+  Keeps track of files in one or more directories
   The file prefix is returned to create the model, map, and JSON files
+  Tags are identified by the path of their directory, <root>/<tag>, or, if
+  depth is larger than 0, up to depth levels of subdirectories further down
+  Directories are scanned concurrently with up to max_workers threads
+  If catalog is the path to a SQLite file, tags are stored there and reused
+  the next time the directories are opened
+  Files are only used once they are completely written, completion and
+  marker are passed to completion_checker
+  Parsed statistics are cached in memory, up to cache_size bytes
+  Binary sidecars of the statistics are read when they are newer than the
+  JSON files, if sidecars is True, missing sidecars are written in the
+  background
   '''
-  def __init__(self, directory):
-    self.directory = directory
-    assert (os.path.isdir(self.directory))
+  def __init__(self, directories, catalog=None, depth=0, max_workers=4,
+               completion='stable', marker='{tag}.done',
+               cache_size=64*1024*1024, sidecars=False):
+    if (isinstance(directories, basestring)):
+      directories = [directories]
+    self.roots = [ os.path.abspath(directory) for directory in directories ]
+    for root in self.roots:
+      assert (os.path.isdir(root))
+    self.depth = depth
+    self.max_workers = max(1, max_workers)
+    self.pool = None
     self.file_extensions = ['json', 'pdb', 'mtz']
-    self.unique_prefixes = list()
-    self.unique_times = list()
+    self.catalog = None
+    if (catalog is not None):
+      try:
+        self.catalog = tag_catalog(catalog, self.roots)
+      except sqlite3.Error as e:
+        print('Catalog %s is not available (%s)' % (catalog, e))
+    if (self.catalog is not None):
+      self.index = self.catalog
+    else:
+      self.index = tag_index()
+    self.cycles = cycle_index(extensions=tuple(self.file_extensions[1:]))
+    self.cycle_dir_mtimes = dict()  # tag -> directory mtime at last listing
+    self.completion = completion_checker(mode=completion, marker=marker)
+    self.writing_tags = set()       # tracked tags with files being written
+    self.identified_tag = None      # tag of the last get_artifact_identities
+    self.identified_event = False   # events for it since then
+    self.artifact_prefix = None     # prefix for artifacts
+    self.artifacts = dict()         # path -> identity when last shown
+    self.sidecars = sidecars
+    self.tables = table_cache(max_size=cache_size, load=self.load_tables)
+    self.trends = trend_store()
+    self.trends_loaded = False
+    self.trend_queue = collections.deque()   # tags to read for trends
+    self.trend_batch = 256
+    self.dirty_cycles = dict()      # tag -> cycle not yet in the catalog
+    self.dirty_statistics = dict()  # tag -> Table 1 values not yet stored
     self.current_index = -1
 
+    # negative cache, tag -> directory mtime when the tag was incomplete
+    # (None if the directory was still changing)
+    self.incomplete_tags = dict()
+    # directory listings, path -> (mtime, subdirectories)
+    # subdirectories is None for directories that are not descended into
+    self.listings = dict()
+    self.saved_listings = None
+    if (self.catalog is not None):
+      self.incomplete_tags = self.catalog.get_incomplete()
+      listings = self.catalog.get_meta('listings')
+      if (listings):
+        self.saved_listings = listings
+        for path, mtime in json.loads(listings).iteritems():
+          self.listings[path] = (mtime, None)
+    # directories modified more recently than this (seconds) are probed again
+    # since filesystems with coarse timestamps can hide a change
+    self.settle_time = 2.0
+
+    # navigation and additions to the index may happen on different threads
+    self.lock = threading.RLock()
+
+    # event-driven updates, see start_watching
+    self.watcher = None
+    self.watching = False           # all directories are watched
+    self.event_lock = threading.Lock()
+    self.pending_tags = set()
+    self.rescan_needed = True
+
+  def start_watching(self, callback=None):
+    '''
+    Use inotify to find new and completed tags instead of listing the
+    directories on every update, callback is called from the watcher thread
+    whenever new events arrive
+    The directories are polled until the watcher thread has added its
+    watches (see watcher_ready), so this returns at once
+    False is returned if inotify is not available and polling is used instead
+    '''
+    try:
+      watcher = directory_watcher(self, callback)
+    except OSError as e:
+      print('Directory watching is not available (%s), polling instead' % e)
+      return False
+    with self.event_lock:
+      self.watcher = watcher
+      self.watching = False
+      self.rescan_needed = True
+    watcher.start()
+    return True
+
+  def watcher_ready(self, watcher):
+    '''
+    Called from the watcher thread once all directories are watched, the
+    next scan lists the directories once more for the tags that were created
+    while the watches were added
+    '''
+    with self.event_lock:
+      if (self.watcher is watcher):
+        self.watching = True
+        self.rescan_needed = True
+
+  def stop_watching(self):
+    '''
+    Stop the watcher thread and go back to polling the directories
+    '''
+    with self.event_lock:
+      watcher = self.watcher
+      self.watcher = None
+      self.watching = False
+      self.rescan_needed = True
+    if (watcher is not None):
+      watcher.stop()
+
+  def tag_created(self, tag):
+    '''
+    Event from the watcher: a new tag directory was created
+    '''
+    with self.event_lock:
+      self.pending_tags.add(tag)
+      self.incomplete_tags.pop(tag, None)
+
+  def file_completed(self, tag, filename, closed=False):
+    '''
+    Event from the watcher: a file in a tag directory was created, or closed
+    after writing or moved into place if closed is True
+    A closed result file is complete without waiting for it to be stable
+    '''
+    if ( closed and
+         ( (filename == os.path.basename(tag) + '.' + self.file_extensions[0])
+           or (self.cycles.parse(tag, filename) is not None) ) ):
+      self.completion.file_closed(os.path.join(tag, filename))
+    with self.event_lock:
+      if (tag in self.index):
+        # checked by refresh_cycles and get_artifact_identities
+        self.writing_tags.add(tag)
+        if (tag == self.identified_tag):
+          self.identified_event = True
+      else:
+        self.pending_tags.add(tag)
+        self.incomplete_tags.pop(tag, None)
+
+  def is_writing(self):
+    '''
+    Return True if tags are waiting to be checked again, e.g. because their
+    files were still being written at the last update
+    '''
+    with self.event_lock:
+      return (len(self.pending_tags) > 0)
+
+  def request_rescan(self):
+    '''
+    Events were lost, the next update lists all directories
+    '''
+    with self.event_lock:
+      self.rescan_needed = True
+      self.listings = dict()
+
+  def map(self, function, items):
+    '''
+    Apply function to each item using the thread pool, the results are
+    returned in the same order as items
+    '''
+    if ( (self.max_workers == 1) or (len(items) < 2) ):
+      return [ function(item) for item in items ]
+    chunksize = max(1, len(items) // (4 * self.max_workers))
+    return self.get_pool().map(function, items, chunksize)
+
+  def get_pool(self):
+    with self.lock:
+      if (self.pool is None):
+        self.pool = multiprocessing.pool.ThreadPool(self.max_workers)
+      return self.pool
+
   def update_unique_files(self):
     '''
     check all files and keep those that have all 3 types of files that follow
     <directory>/<tag>/<tag>.json
-    <directory>/<tag>/<tag>_001.pdb
-    <directory>/<tag>/<tag>_001.mtz
+    <directory>/<tag>/<tag>_NNN.pdb
+    <directory>/<tag>/<tag>_NNN.mtz
+    where NNN is a refinement cycle (001 - 999)
     add new files to be tracked, sorted by modification time
+    When the directories are being watched, only tags with pending events are
+    checked and nothing is listed when there are no events
+    Directories are only listed again after they change and incomplete tags
+    are only checked again after their directory changes
+    The list of new tags is returned
+    This function should only be called from one thread at a time, but
+    navigation is safe from other threads while it runs
+    '''
+    with self.event_lock:
+      full_scan = (not self.watching) or self.rescan_needed
+      self.rescan_needed = False
+      pending_tags = self.pending_tags
+      self.pending_tags = set()
+    now = time.time()
+    if (full_scan):
+      # each root produces a sorted list of new directories, merge them into
+      # one ordered stream and add the incomplete tags that may have changed
+      found = list()
+      for root_found, listings in self.map(self.scan_root, self.roots):
+        found.append(root_found)
+        for path, listing in listings.iteritems():
+          if (listing is None):
+            self.listings.pop(path, None)
+          else:
+            self.listings[path] = listing
+      candidates = list(heapq.merge(*found))
+      seen = set([ tag for sort_key, tag, entry in candidates ])
+      candidates = [ (tag, entry) for sort_key, tag, entry in candidates ]
+      candidates.extend([ (tag, None) for tag in self.incomplete_tags.keys()
+                          if (tag not in seen) ])
+      self.save_listings()
+    else:
+      candidates = [ (tag, None) for tag in pending_tags
+                     if (tag not in self.index) ]
+    new_prefixes = list()
+    new_incomplete = list()
+    results = self.map(self.probe_tag,
+                       [ (tag, entry, now) for tag, entry in candidates ])
+    still_writing = list()
+    for tag, mtime, dir_mtime, writing in results:
+      if (mtime is not None):
+        self.incomplete_tags.pop(tag, None)
+        new_prefixes.append((tag, mtime))
+      elif (dir_mtime is not False):
+        self.incomplete_tags[tag] = dir_mtime
+        new_incomplete.append((tag, dir_mtime))
+      if (writing):
+        still_writing.append(tag)
+    if (len(still_writing) > 0):
+      # files are growing without changing the directory, look again at the
+      # next update even if there are no new events
+      with self.event_lock:
+        self.pending_tags.update(still_writing)
+    self.add_tags(new_prefixes)
+    if (self.catalog is not None):
+      self.catalog.set_incomplete(new_incomplete)
+      self.flush_catalog()
+    return [ tag for tag, mtime in new_prefixes ]
+
+  def add_tags(self, new_prefixes):
+    '''
+    Add (tag, mtime) tuples to the index, the current position is moved so
+    that it stays on the same tag
+    '''
+    if (len(new_prefixes) == 0):
+      return
+    # writing the catalog is slow, navigation only waits for the new tags to
+    # be published
+    update = self.index.prepare(new_prefixes)
+    with self.lock:
+      current_key = None
+      if ( (self.current_index >= 0) and
+           (self.current_index < len(self.index)) ):
+        current_key = tag_sort_key(self.index[self.current_index])
+      self.index.publish(update)
+      if (current_key is not None):
+        self.current_index += len(
+          [ tag for tag, mtime in new_prefixes
+            if (tag_sort_key(tag) < current_key) ])
+
+  def scan_root(self, root):
+    '''
+    Return a sorted list of (sort key, path, entry) tuples for the directories
+    below root that are not tracked yet, and the updated directory listings
+    '''
+    found = list()
+    listings = dict()
+    self.scan_directory(root, 0, found, listings)
+    found.sort()
+    return found, listings
+
+  def scan_directory(self, path, level, found, listings):
+    '''
+    Add new subdirectories of path to found, descending into subdirectories
+    while level is less than the depth
+    A directory is only listed again when its modification time changed
+    '''
+    mtime = self.get_directory_mtime(path)
+    if (mtime is None):
+      listings[path] = None
+      return
+    descend = (level < self.depth)
+    listing = self.listings.get(path)
+    if ( (listing is not None) and (listing[0] == mtime) and
+         ( (not descend) or (listing[1] is not None) ) ):
+      subdirectories = listing[1]
+    else:
+      entries = self.list_subdirectories(path)
+      unknown = self.index.unknown([ tag for tag, entry in entries ])
+      found.extend([ (tag_sort_key(tag), tag, entry) for tag, entry in entries
+                     if (tag in unknown) ])
+      subdirectories = None
+      if (descend):
+        subdirectories = [ tag for tag, entry in entries ]
+      if (time.time() - mtime > self.settle_time):
+        listings[path] = (mtime, subdirectories)
+      else:
+        listings[path] = None
+    if (descend):
+      for subdirectory in subdirectories:
+        self.scan_directory(subdirectory, level + 1, found, listings)
+
+  def save_listings(self):
+    '''
+    Keep the modification times of the directories that are not descended
+    into, so that a restart does not have to list them again
+    '''
+    if (self.catalog is None):
+      return
+    listings = json.dumps(dict(
+      [ (path, listing[0]) for path, listing in self.listings.iteritems()
+        if (listing[1] is None) ]), sort_keys=True)
+    if (listings != self.saved_listings):
+      self.catalog.set_meta('listings', listings)
+      self.saved_listings = listings
+
+  def probe_tag(self, args):
+    '''
+    Check a possible tag, returns (tag, mtime, directory mtime, writing)
+    mtime is the modification time of the JSON file if the tag is complete,
+    otherwise None and directory mtime is the value for the negative cache
+    (False if the cache is still valid)
+    writing is True if some of the result files are still being written
+    '''
+    tag, entry, now = args
+    dir_mtime = None
+    cached = self.incomplete_tags.get(tag, False)
+    if (cached is not False):
+      dir_mtime = self.get_directory_mtime(tag, entry)
+      if (dir_mtime == cached):
+        return tag, None, False, False
+    mtime, writing = self.check_tag(tag)
+    if (mtime is not None):
+      return tag, mtime, None, writing
+    if (dir_mtime is None):
+      dir_mtime = self.get_directory_mtime(tag, entry)
+    if ( (dir_mtime is None) or (now - dir_mtime <= self.settle_time) or
+         writing ):
+      # recently modified, check again at the next update
+      dir_mtime = None
+    return tag, None, dir_mtime, writing
+
+  def list_subdirectories(self, path):
+    '''
+    Return a list of (path, entry) tuples for the subdirectories of path,
+    entry is the scandir entry if available, None otherwise
+    The file type comes from the directory listing when possible so the
+    subdirectories are not stat'ed individually
+    '''
+    subdirectories = list()
+    try:
+      if (scandir is not None):
+        for entry in scandir(path):
+          try:
+            if (entry.is_dir()):
+              subdirectories.append((os.path.join(path, entry.name), entry))
+          except OSError:
+            continue
+      else:
+        for filename in os.listdir(path):
+          subdirectory = os.path.join(path, filename)
+          if (os.path.isdir(subdirectory)):
+            subdirectories.append((subdirectory, None))
+    except OSError:
+      pass
+    return subdirectories
+
+  def get_directory_mtime(self, path, entry=None):
+    '''
+    Return the modification time of a directory, None if it does not exist
+    '''
+    try:
+      if (entry is not None):
+        return entry.stat().st_mtime
+      return os.stat(path).st_mtime
+    except OSError:
+      return None
+
+  def check_tag(self, tag):
+    '''
+    Return (mtime, writing), mtime is the modification time of the JSON file
+    if all files for tag exist and are completely written, otherwise None
+    writing is True if some of the files are still being written
+    The refinement cycles found in the directory are recorded
+    '''
+    filenames = self.list_tag_files(tag)
+    if (filenames is None):
+      return None, False
+    complete, writing = self.complete_files(tag, filenames)
+    with self.event_lock:
+      self.add_cycle_files(tag, complete)
+    cycle = self.get_cycle(tag)
+    test_filename = os.path.basename(tag) + '.' + self.file_extensions[0]
+    if ( (cycle is None) or (test_filename not in complete) ):
+      return None, writing
+    try:
+      return os.path.getmtime(os.path.join(tag, test_filename)), writing
+    except OSError:
+      return None, writing
+
+  def complete_files(self, tag, filenames):
+    '''
+    Return (complete, writing), complete is the list of files that can
+    change the JSON file or the latest refinement cycle of tag and have been
+    completely written, writing is True if some of them are still being
+    written
+    Cycles are checked from the newest one and older cycles are not checked
+    once a complete cycle is found
+    '''
+    latest = self.get_cycle(tag)
+    if (latest is None):
+      latest = 0
+    new_cycles = dict()
+    for filename in filenames:
+      parsed = self.cycles.parse(tag, filename)
+      if ( (parsed is not None) and (parsed[0] > latest) ):
+        new_cycles.setdefault(parsed[0], list()).append(filename)
+    complete = list()
+    writing = False
+    now = time.time()
+    for cycle in sorted(new_cycles.keys(), reverse=True):
+      written = [ filename for filename in new_cycles[cycle]
+                  if (self.completion.is_complete(tag, filename, now)) ]
+      writing = writing or (len(written) < len(new_cycles[cycle]))
+      complete.extend(written)
+      if (len(written) == len(self.cycles.extensions)):
+        break
+    json_filename = os.path.basename(tag) + '.' + self.file_extensions[0]
+    if (json_filename in filenames):
+      if (self.completion.is_complete(tag, json_filename, now)):
+        complete.append(json_filename)
+      else:
+        writing = True
+    return complete, writing
+
+  def list_tag_files(self, tag):
+    '''
+    Return the set of filenames in the directory for tag, None if the
+    directory cannot be read
+    '''
+    try:
+      return set(os.listdir(tag))
+    except OSError:
+      return None
+
+  def refresh_cycles(self, tag):
+    '''
+    Return the latest complete refinement cycle for tag
+    When the directory is watched, it is only listed the first time and after
+    events. Otherwise the directory is only listed again if its modification
+    time changed since the last listing or files were still being written.
+    '''
+    listed = (tag in self.cycle_dir_mtimes)
+    with self.event_lock:
+      writing = (tag in self.writing_tags)
+      self.writing_tags.discard(tag)
+    if ( (not self.watching) or (not listed) or writing ):
+      dir_mtime = self.get_directory_mtime(tag)
+      if ( (not listed) or writing or (dir_mtime is None) or
+           (dir_mtime != self.cycle_dir_mtimes[tag]) ):
+        filenames = self.list_tag_files(tag)
+        if (filenames is not None):
+          complete, writing = self.complete_files(tag, filenames)
+          with self.event_lock:
+            self.add_cycle_files(tag, complete)
+            if (writing):
+              self.writing_tags.add(tag)
+        if ( (dir_mtime is not None) and
+             (time.time() - dir_mtime > self.settle_time) ):
+          self.cycle_dir_mtimes[tag] = dir_mtime
+        else:
+          # listed, but check again since the directory is still changing
+          self.cycle_dir_mtimes[tag] = None
+        self.flush_catalog()
+    return self.get_cycle(tag)
+
+  def get_cycle(self, tag):
+    '''
+    Return the latest known refinement cycle for tag without accessing the
+    directory, see refresh_cycles
+    '''
+    with self.event_lock:
+      cycle = self.cycles.get_latest(tag)
+    if ( (cycle is None) and (self.catalog is not None) ):
+      cycle = self.catalog.get_cycle(tag)
+    return cycle
+
+  def add_cycle_files(self, tag, filenames):
+    '''
+    Update the refinement cycles for tag and store a new latest cycle in the
+    catalog, the caller holds event_lock
+    Only files newer than the latest cycle are passed (see complete_files),
+    since the cycle is only kept in memory until it is in the catalog
+    '''
+    if ( self.cycles.add_files(tag, filenames) and
+         (self.catalog is not None) ):
+      self.dirty_cycles[tag] = self.cycles.get_latest(tag)
+
+  def flush_catalog(self):
+    '''
+    Write new refinement cycles and Table 1 values to the catalog, this is
+    called by the scan, so the GUI does not wait for the transactions
+    '''
+    if (self.catalog is None):
+      return
+    with self.event_lock:
+      dirty_cycles = self.dirty_cycles
+      self.dirty_cycles = dict()
+      dirty_statistics = self.dirty_statistics
+      self.dirty_statistics = dict()
+    self.catalog.set_cycles(dirty_cycles.items())
+    self.catalog.store_statistics_batch(dirty_statistics.items())
+    # stored cycles are read from the catalog from now on
+    with self.event_lock:
+      for tag, cycle in dirty_cycles.iteritems():
+        if ( (tag not in self.dirty_cycles) and
+             (self.cycles.get_latest(tag) == cycle) ):
+          self.cycles.forget(tag)
+
+  def store_statistics(self, tag, t1):
+    '''
+    Keep the Table 1 values for tag in the trends and in the catalog, the
+    catalog is written by the next scan (see flush_catalog)
+    '''
+    scalars = table_one_scalars(t1)
+    if (self.catalog is not None):
+      with self.event_lock:
+        self.dirty_statistics[tag] = scalars
+    self.trends.update(tag, scalars)
+
+  def queue_trends(self, tags):
+    '''
+    Queue new tags for the trends, the first call queues every known tag
+    Stored statistics are loaded from the catalog instead of being read again
+    '''
+    if (not self.trends_loaded):
+      self.trends_loaded = True
+      if (self.catalog is not None):
+        statistics = self.catalog.get_all_statistics(self.trends.keys)
+        for tag, (mtime, scalars) in statistics.iteritems():
+          self.trends.add(tag, mtime, scalars)
+        tags = self.catalog.get_tags_without_statistics()
+      else:
+        with self.lock:
+          tags = [ self.index[i] for i in xrange(len(self.index)) ]
+    self.trend_queue.extend([ tag for tag in tags if (tag not in self.trends) ])
+
+  def update_trends(self):
+    '''
+    Read Table 1 for the next batch of queued tags into the trends
+    Returns the number of tags that were read
+    '''
+    tags = list()
+    while ( (len(self.trend_queue) > 0) and (len(tags) < self.trend_batch) ):
+      tags.append(self.trend_queue.popleft())
+    points = [ point for point in self.map(self.read_trend_point, tags)
+               if (point is not None) ]
+    for tag, mtime, scalars in points:
+      self.trends.add(tag, mtime, scalars)
+    if (self.catalog is not None):
+      self.catalog.store_statistics_batch(
+        [ (tag, scalars) for tag, mtime, scalars in points ])
+    return len(tags)
+
+  def read_trend_point(self, tag):
+    '''
+    Return (tag, mtime, Table 1 values) from the JSON file of tag or None if
+    it cannot be read
+    '''
+    path = os.path.join(tag, os.path.basename(tag) + '.' +
+                        self.file_extensions[0])
+    try:
+      mtime = os.path.getmtime(path)
+      t1 = self.load_tables(path, table_two=False)['Table 1']
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+    return tag, mtime, table_one_scalars(t1)
+
+  def close(self):
+    '''
+    Stop watching and scanning and close the catalog
+    '''
+    self.stop_watching()
+    if (self.pool is not None):
+      self.pool.close()
+      self.pool = None
+    if (self.catalog is not None):
+      self.flush_catalog()
+      self.catalog.close()
+
+  def get_cycle_files(self, prefix, cycle):
+    '''
+    Return the model and map filenames for a prefix and refinement cycle
+    '''
+    suffix = '_%03d.' % cycle
+    return (prefix + suffix + self.file_extensions[1],
+            prefix + suffix + self.file_extensions[2])
+
+  def load_tables(self, path, table_two=True):
+    '''
+    Return the statistics from a JSON file, see read_tables
+    The sidecar is used if it is newer than the JSON file. Otherwise, if
+    sidecars are enabled, the sidecar is written in the background.
+    If table_two is False, only Table 1 may be returned.
+    '''
+    sidecar = sidecar_path(path)
+    try:
+      if (os.path.getmtime(sidecar) > os.path.getmtime(path)):
+        return read_sidecar(sidecar)
+    except (IOError, OSError, ValueError, KeyError):
+      pass
+    if ( (not table_two) and (not self.sidecars) ):
+      return load_json_keys(path, ('Table 1',))
+    tables = read_tables(path)
+    if (self.sidecars):
+      try:
+        self.get_pool().apply_async(write_sidecar, (sidecar, tables))
+      except ValueError:
+        pass    # closed
+    return tables
+
+  def get_tables(self, prefix):
+    '''
+    Return the parsed statistics (Table 1 and Table 2) for prefix
+    '''
+    return self.tables.get(prefix + '.' + self.file_extensions[0])
+
+  def get_neighbours(self, radius):
+    '''
+    Return the prefixes of up to radius tags on either side of the current
+    position, the closest ones first
+    '''
+    prefixes = list()
+    with self.lock:
+      for offset in xrange(1, radius + 1):
+        for i in (self.current_index + offset, self.current_index - offset):
+          if ( (i >= 0) and (i < len(self.index)) ):
+            tag = self.index[i]
+            prefixes.append(os.path.join(tag, os.path.basename(tag)))
+    return prefixes
+
+  def get_earlier(self, count):
+    '''
+    Return the prefixes of up to count tags before the current position, the
+    closest ones first
+    '''
+    prefixes = list()
+    with self.lock:
+      for i in xrange(self.current_index - 1,
+                      max(self.current_index - count, 0) - 1, -1):
+        tag = self.index[i]
+        prefixes.append(os.path.join(tag, os.path.basename(tag)))
+    return prefixes
+
+  def prefetch(self, prefix):
+    '''
+    Read the files for prefix ahead of time, the statistics are parsed into
+    the cache and the model and maps of the latest known refinement cycle are
+    read into the page cache for Coot
+    '''
+    try:
+      self.get_tables(prefix)
+    except (IOError, OSError, ValueError, KeyError):
+      return
+    cycle = self.get_cycle(os.path.dirname(prefix))
+    if (cycle is not None):
+      for path in self.get_cycle_files(prefix, cycle):
+        readahead(path)
+
+  def get_artifact_paths(self, prefix, cycle):
+    '''
+    Return a list of (artifact, path) for prefix and cycle, the artifacts
+    are 'json', 'model' and 'maps'
+    '''
+    paths = [('json', prefix + '.' + self.file_extensions[0])]
+    if (cycle is not None):
+      model_file, mtz_file = self.get_cycle_files(prefix, cycle)
+      paths.extend([('model', model_file), ('maps', mtz_file)])
+    return paths
+
+  def get_artifact_identities(self, tag, cycle):
+    '''
+    Return a dictionary of path -> (identity, complete) for the artifacts of
+    tag and cycle, identity is None if the file does not exist
+    This accesses the filesystem, so it is called by the scan_worker and the
+    result is passed to changed_artifacts
+    When the directories are watched, the files are only checked the first
+    time and after events for tag, until they are completely written
+    '''
+    identities = dict()
+    if (self.watching):
+      with self.event_lock:
+        if ( (tag == self.identified_tag) and (not self.identified_event) ):
+          return identities
+        self.identified_tag = tag
+        self.identified_event = False
+    self.identified_tag = tag
+    prefix = os.path.join(tag, os.path.basename(tag))
+    writing = False
+    for artifact, path in self.get_artifact_paths(prefix, cycle):
+      try:
+        st = os.stat(path)
+      except OSError:
+        identities[path] = (None, False)
+        continue
+      complete = self.completion.is_complete(tag, os.path.basename(path),
+                                             st=st)
+      identities[path] = (file_identity(path, st), complete)
+      writing = writing or (not complete)
+    if (writing):
+      # check again at the next update
+      with self.event_lock:
+        self.identified_event = True
+    return identities
+
+  def changed_artifacts(self, prefix, cycle, identities=None):
+    '''
+    Return the set of artifacts ('json', 'model', 'maps') for prefix and
+    cycle that should be (re)loaded
+    Artifacts are tracked by identity (size, mtime, inode), so everything is
+    returned for a new prefix or cycle, but for the shown files only the ones
+    that have been rewritten and are completely written again are returned
+    The files are not accessed here, identities comes from
+    get_artifact_identities, the identity of a file that was shown before it
+    was scanned is recorded by the next scan
+    '''
+    if (prefix != self.artifact_prefix):
+      self.artifact_prefix = prefix
+      self.artifacts = dict()
+    if (identities is None):
+      identities = dict()
+    changed = set()
+    for artifact, path in self.get_artifact_paths(prefix, cycle):
+      scanned = (path in identities)
+      identity, complete = identities.get(path, (None, False))
+      if (path not in self.artifacts):
+        if ( scanned and (identity is None) ):
+          continue
+        self.artifacts[path] = identity
+        changed.add(artifact)
+      elif ( (identity is None) or (identity == self.artifacts[path]) ):
+        continue
+      elif (self.artifacts[path] is None):
+        # first scan since the file was shown
+        self.artifacts[path] = identity
+      elif (complete):
+        self.artifacts[path] = identity
+        changed.add(artifact)
+      # otherwise being rewritten, check again at the next update
+    return changed
+
+  def at_latest(self):
+    '''
+    Determine if current position is at the most recent file
+    '''
+    with self.lock:
+      if (self.current_index == (len(self.index) - 1)):
+        return True
+      return False
+
+  def at_start(self):
+    '''
+    Determine if current position is at the first file
+    '''
+    with self.lock:
+      return (self.current_index == 0)
+
+  def get_current(self, full_path=False):
+    '''
+    Return the file at the current position
+    '''
+    path = None
+    with self.lock:
+      if (len(self.index) > 0):
+        tag = self.index[self.current_index]
+        path = os.path.basename(tag)
+        if (full_path):
+          path = os.path.join(tag, path)
+    return path
+
+  def get_root(self, tag):
+    '''
+    Return the root directory of a tag or None
+    '''
+    for root in self.roots:
+      if (tag.startswith(os.path.join(root, ''))):
+        return root
+    return None
+
+  def get_label(self, tag):
+    '''
+    Return the name of a tag relative to its root directory
+    '''
+    root = self.get_root(tag)
+    if (root is not None):
+      return os.path.relpath(tag, root)
+    return os.path.basename(tag)
+
+  def get_latest(self, full_path=False):
+    '''
+    Return the most recent file and update current position
+    None is returned if the current position is already at the end
+    '''
+    with self.lock:
+      last_index = len(self.index) - 1
+      if (self.current_index == last_index):
+        return None
+      else:
+        self.current_index = last_index
+        if (self.current_index > -1):
+          return self.get_current(full_path)
+        else:
+          self.current_index = 0
+          return None
+
+  def get_previous(self, full_path=False):
+    '''
+    Return the previous file and update current position
+    None is returned if the current position is at the start
+    '''
+    with self.lock:
+      self.current_index -= 1
+      if (self.current_index > -1):
+        return self.get_current(full_path)
+      else:
+        self.current_index = 0
+        return None
+
+  def get_next(self, full_path=False):
+    '''
+    Return the next file and update current position
+    None is returned if the current position is at the end
+    '''
+    with self.lock:
+      self.current_index += 1
+      if (self.current_index < len(self.index)):
+        return self.get_current(full_path)
+      else:
+        self.current_index = len(self.index) - 1
+        return None
+
+# =============================================================================
+class scan_worker(threading.Thread):
+  '''
+  Background thread that updates a file_manager so that a slow filesystem
+  does not block the GUI
+  Requests are coalesced, after each scan callback(new_tags, cycles,
+  identities) is called on the wx main loop, where new_tags is the list of
+  new tags, cycles maps the tags passed to request to their latest
+  refinement cycle and identities has the files of these tags and cycles,
+  see file_manager.get_artifact_identities
+  The callback is also called, without results, when a scan fails, so that
+  the caller always knows when the scan is over
+  When the directories are watched, tags whose files were still being
+  written are checked again after the minimum interval of the completion
+  check instead of waiting for the next request
+  If trends_callback is set, Table 1 of new tags is read for the trends
+  between scans and trends_callback() is called on the wx main loop after
+  each batch
+  '''
+  def __init__(self, files, callback, trends_callback=None):
+    threading.Thread.__init__(self, name='scan_worker')
+    self.daemon = True
+    self.files = files
+    self.callback = callback
+    self.trends_callback = trends_callback
+    self.lock = threading.Lock()
+    self.requested = threading.Event()
+    self.stop_event = threading.Event()
+    self.refresh_tags = set()
+    self.retry_timer = None
+
+  def request(self, tags=None):
     '''
-    all_files = os.listdir(self.directory)
-    new_prefixes = list()
-    for filename in all_files:
-      if (os.path.isdir(os.path.join(self.directory, filename))):
-        tag = os.path.basename(filename)
-        if (tag not in self.unique_prefixes):
-          expected_files = [ tag + '.' + self.file_extensions[0],
-                             tag + '_001.' + self.file_extensions[1],
-                             tag + '_001.' + self.file_extensions[2] ]
-          complete = True
-          for i in xrange(len(expected_files)):
-            complete = complete and os.path.isfile(
-              os.path.join(self.directory, tag, expected_files[i]))
-          if (complete):
-            test_filename = tag + '.' + self.file_extensions[0]
-            test_filename = os.path.join(self.directory, tag, test_filename)
-            new_prefixes.append((tag, os.path.getmtime(test_filename)))
-    if (len(new_prefixes) > 0):
-      new_prefixes.sort(key=lambda x: x[1])
-      for i in xrange(len(new_prefixes)):
-        self.unique_prefixes.append(new_prefixes[i][0])
-        self.unique_times.append(new_prefixes[i][1])
-
-      # overide sorting, use alphanumeric order
-      self.unique_prefixes.sort()
-
-  def at_latest(self):
+    Ask for a scan, the refinement cycles of tags are checked as well
+    Can be called from any thread
     '''
-    Determine if current position is at the most recent file
+    with self.lock:
+      if (tags is not None):
+        self.refresh_tags.update([ tag for tag in tags if (tag is not None) ])
+      self.requested.set()
+
+  def run(self):
+    while (not self.stop_event.is_set()):
+      self.requested.wait(0.5)
+      with self.lock:
+        if (not self.requested.is_set()):
+          continue
+        self.requested.clear()
+        refresh_tags = self.refresh_tags
+        self.refresh_tags = set()
+      try:
+        new_tags = self.files.update_unique_files()
+        cycles = dict([ (tag, self.files.refresh_cycles(tag))
+                        for tag in refresh_tags ])
+        identities = dict()
+        for tag, cycle in cycles.iteritems():
+          identities.update(self.files.get_artifact_identities(tag, cycle))
+      except Exception:
+        if (self.stop_event.is_set()):
+          break
+        traceback.print_exc()
+        # check the tags again at the next scan
+        with self.lock:
+          self.refresh_tags.update(refresh_tags)
+        new_tags = list()
+        cycles = dict()
+        identities = dict()
+      if (not self.stop_event.is_set()):
+        wx.CallAfter(self.callback, new_tags, cycles, identities)
+        if ( self.files.watching and self.files.is_writing() ):
+          self.retry()
+      if (self.trends_callback is not None):
+        self.update_trends(new_tags)
+
+  def retry(self):
     '''
-    if (self.current_index == (len(self.unique_prefixes) - 1)):
-      return True
-    return False
-
-  def at_start(self):
+    Ask for another scan once files that are being written may be complete
     '''
-    Determine if current position is at the first file
+    if ( (self.retry_timer is not None) and self.retry_timer.is_alive() ):
+      return
+    self.retry_timer = threading.Timer(self.files.completion.min_interval,
+                                       self.request)
+    self.retry_timer.daemon = True
+    self.retry_timer.start()
+
+  def update_trends(self, new_tags):
+    '''
+    Read queued tags for the trends until the next scan is requested
     '''
-    return (self.current_index == 0)
+    try:
+      self.files.queue_trends(new_tags)
+      while ( (not self.requested.is_set()) and
+              (self.files.update_trends() > 0) ):
+        if (not self.stop_event.is_set()):
+          wx.CallAfter(self.trends_callback)
+    except Exception:
+      if (not self.stop_event.is_set()):
+        traceback.print_exc()
+
+  def stop(self):
+    self.stop_event.set()
+    self.requested.set()
+    if (self.retry_timer is not None):
+      self.retry_timer.cancel()
 
-  def get_current(self, full_path=False):
+# =============================================================================
+class prefetch_worker(threading.Thread):
+  '''
+  Background thread that reads the tags around the current position of a
+  file_manager, so that stepping through them with Prev/Next does not wait
+  for the filesystem
+  Requests are coalesced and always use the latest position
+  '''
+  def __init__(self, files, radius=2):
+    threading.Thread.__init__(self, name='prefetch_worker')
+    self.daemon = True
+    self.files = files
+    self.radius = radius
+    self.requested = threading.Event()
+    self.stop_event = threading.Event()
+
+  def request(self):
     '''
-    Return the file at the current position
+    Ask for the tags around the current position to be read
+    Can be called from any thread
     '''
-    path = None
-    if (len(self.unique_prefixes) > 0):
-      path = self.unique_prefixes[self.current_index]
-      if (full_path):
-        path = os.path.join(self.directory, path, path)
-    return path
+    self.requested.set()
+
+  def run(self):
+    while (not self.stop_event.is_set()):
+      self.requested.wait(0.5)
+      if (not self.requested.is_set()):
+        continue
+      self.requested.clear()
+      if (self.stop_event.is_set()):
+        break
+      try:
+        self.files.map(self.files.prefetch,
+                       self.files.get_neighbours(self.radius))
+      except Exception:
+        if (self.stop_event.is_set()):
+          break
+        traceback.print_exc()
 
-  def get_latest(self, full_path=False):
+  def stop(self):
+    self.stop_event.set()
+    self.requested.set()
+
+# =============================================================================
+class update_scheduler(object):
+  '''
+  Decides when the next update should happen
+  The interval starts at interval seconds, backs off exponentially up to
+  max_interval while nothing changes and goes back to interval when new
+  results arrive. It is never shorter than cost_factor times the cost of
+  the last update, so slow updates cannot pile up. A tick that arrives
+  while an update is still running is skipped, and ticks that were missed
+  because the main loop was busy are merged into the next one.
+  '''
+  def __init__(self, interval, max_interval=None, backoff=2.0,
+               cost_factor=2.0):
+    self.base_interval = float(interval)
+    if (max_interval is None):
+      max_interval = 8.0 * self.base_interval
+    self.max_interval = max(float(max_interval), self.base_interval)
+    self.backoff = backoff
+    self.cost_factor = cost_factor
+    self.interval = self.base_interval
+    self.scheduled = None        # time the next tick is expected
+    self.started = None          # start time of the update in flight
+
+    # counters
+    self.n_ticks = 0
+    self.n_updates = 0
+    self.n_missed = 0
+    self.n_skipped = 0
+    self.last_cost = 0.0
+
+  def schedule(self, now=None):
     '''
-    Return the most recent file and update current position
-    None is returned if the current position is already at the end
+    Return the delay in milliseconds until the next tick
     '''
-    last_index = len(self.unique_prefixes) - 1
-    if (self.current_index == last_index):
-      return None
-    else:
-      self.current_index = last_index
-      if (self.current_index > -1):
-        return self.get_current(full_path)
-      else:
-        self.current_index = 0
-        return None
+    if (now is None):
+      now = time.time()
+    self.scheduled = now + self.interval
+    return max(1, int(round(1000.0 * self.interval)))
 
-  def get_previous(self, full_path=False):
+  def tick(self, now=None):
     '''
-    Return the previous file and update current position
-    None is returned if the current position is at the start
+    Called for each timer tick, True is returned if an update should start
     '''
-    self.current_index -= 1
-    if (self.current_index > -1):
-      return self.get_current(full_path)
-    else:
-      self.current_index = 0
-      return None
-
-  def get_next(self, full_path=False):
+    if (now is None):
+      now = time.time()
+    self.n_ticks += 1
+    if (self.scheduled is not None):
+      late = now - self.scheduled
+      if (late > self.interval):
+        self.n_missed += int(late // self.interval)
+    if (self.started is not None):
+      self.n_skipped += 1
+      return False
+    self.started = now
+    return True
+
+  def finish(self, changed, now=None):
     '''
-    Return the next file and update current position
-    None is returned if the current position is at the end
+    Called when an update is done, changed is True if there were new results
     '''
-    self.current_index += 1
-    if (self.current_index < len(self.unique_prefixes)):
-      return self.get_current(full_path)
+    if (now is None):
+      now = time.time()
+    if (self.started is not None):
+      self.last_cost = now - self.started
+      self.started = None
+    self.n_updates += 1
+    if (changed):
+      self.interval = self.base_interval
     else:
-      self.current_index = len(self.unique_prefixes) - 1
-      return None
+      self.interval = min(self.interval * self.backoff, self.max_interval)
+    self.interval = max(self.interval, self.cost_factor * self.last_cost)
+
+  def get_status(self):
+    return 'Interval: %.1f s   Update: %.2f s   Missed ticks: %d   ' \
+      'Skipped ticks: %d' % (self.interval, self.last_cost, self.n_missed,
+                             self.n_skipped)
 
 # =============================================================================
 class TableOneWidgets(object):
@@ -155,6 +2361,13 @@ class TableOneWidgets(object):
     self.rama = dict()
     self.rama_labels = ('Favored', 'Outliers')
 
+    # last text shown in each widget, widgets are only updated when the text
+    # changes and the sizers are only laid out when a widget changes width
+    self.text = dict()      # (id of widgets, label) -> text
+    self.resized = False
+    self.n_relabels = 0
+    self.n_unchanged = 0
+
     self.sizer.Add(
       self.set_bold(wx.StaticText(parent, label='Data Collection:')),
       0, wx.ALIGN_LEFT, 0)
@@ -181,6 +2394,8 @@ class TableOneWidgets(object):
                   'Ramachandran statistics', 'Anomalous peak height'):
       self.add_row(label, self.refinement_widgets)
 
+    self.min_size = self.sizer.CalcMin()
+
   def set_bold(self, text_widget):
     bold_font = text_widget.GetFont()
     bold_font.SetWeight(wx.FONTWEIGHT_BOLD)
@@ -230,6 +2445,8 @@ class TableOneWidgets(object):
   def update_values(self, t1):
     '''
     Given a parsed JSON object, t1, update the values in the widget
+    Returns True if the size of the table changed, so that the containing
+    window needs a new layout
     '''
     t_dc = t1['Data collection']
     for label in t_dc.keys():
@@ -258,9 +2475,11 @@ class TableOneWidgets(object):
       else:
         self.update_widget(label, self.refinement_widgets, t)
 
+    return self.layout()
+
   def update_widget(self, label, widgets, text):
     '''
-    Change the text of an individual widget
+    Change the text of an individual widget if it is different
     '''
     if ( not (isinstance(text, unicode) or isinstance(text, str)) ):
       try:
@@ -268,193 +2487,942 @@ class TableOneWidgets(object):
       except Exception:
         text = 'N/A'
     if (widgets.has_key(label)):
-      widgets[label].SetLabel(text)
+      key = (id(widgets), label)
+      if (self.text.get(key) == text):
+        self.n_unchanged += 1
+        return
+      self.n_relabels += 1
+      self.text[key] = text
+      widget = widgets[label]
+      width = widget.GetSize().width
+      widget.SetLabel(text)
+      if (widget.GetSize().width != width):
+        self.resized = True
+
+  def layout(self):
+    '''
+    Lay out the table if a widget changed width
+    Returns True if the size of the table changed
+    '''
+    if (not self.resized):
+      return False
+    self.resized = False
+    min_size = self.sizer.CalcMin()
+    if (min_size != self.min_size):
+      self.min_size = min_size
+      return True
+    self.sizer.Layout()
+    return False
 
 # =============================================================================
-class TableTwoWidgets(object):
+# Table 2 columns shown in the top, middle and bottom plots
+table_two_series = (
+  [('No. Measurements', r'N$_{measurements}$'),
+   ('No. Lattices', r'N$_{lattices}$'),
+   ('No. Unique reflections', r'N$_{reflections}$')],
+  [('<Multiplicity>', r'$\langle$Multiplicity$\rangle$'),
+   ('<I/sigI>', r'$\langle$I/sigI$\rangle$')],
+  [('Completeness', 'Completeness'),
+   ('CC1/2', r'CC$_{1/2}$'),
+   ('CCiso', r'CC$_{iso}$'),
+   ('Rsplit',r'R$_{split}$')])
+
+def to_float_array(values, n):
   '''
-  Container for widgets for Table 2 data
+  Convert a list of numbers or text to a float64 array of length n, values
+  that cannot be converted and missing values are NaN
   '''
-  def __init__(self, parent):
+  values = list(values[:n])
+  try:
+    array = numpy.array(values, dtype=numpy.float64)
+  except (TypeError, ValueError):
+    array = numpy.empty(len(values), dtype=numpy.float64)
+    for i, value in enumerate(values):
+      try:
+        array[i] = float(value)
+      except (TypeError, ValueError):
+        array[i] = numpy.nan
+  if (len(array) < n):
+    array = numpy.concatenate([array, numpy.full(n - len(array), numpy.nan)])
+  return array
+
+class table_two_columns(object):
+  '''
+  Columnar representation of Table 2 for plotting
+  Each column in table_two_series is stored as a row of a float64 array,
+  values that are not numbers are NaN and masked out for plotting
+  The parsed JSON object is not modified
+  '''
+  def __init__(self, t2):
+    x_high = t2['Resolution High']
+    x_low = t2['Resolution Low']
+    self.n = min(len(x_high), len(x_low))
+    self.x = numpy.arange(self.n, dtype=numpy.float64)   # equally spaced x
+
+    # labels for resolution range
+    if ( (self.n > 0) and (x_low[0] == 'inf') ):
+      x_low = [r'$\infty$'] + list(x_low[1:])
+    self.range_labels = numpy.char.add(
+      numpy.char.add(self.format_labels(x_low), u' - '),
+      self.format_labels(x_high)).tolist()
+
+    # values
+    self.keys = [ key for series in table_two_series for key, label in series ]
+    self.rows = dict([ (key, i) for i, key in enumerate(self.keys) ])
+    self.values = numpy.vstack([ to_float_array(t2[key], self.n)
+                                 for key in self.keys ])
+    self.valid = ~numpy.isnan(self.values)
+
+  def format_labels(self, values, label_format='%.2f'):
+    '''
+    Return the first n values as text, numbers are rounded to 2 decimals
+    '''
+    numbers = to_float_array(values, self.n)
+    text = numpy.array(list(values[:self.n]), dtype=numpy.unicode_)
+    formatted = numpy.char.mod(label_format, numpy.round(numbers, 2))
+    return numpy.where(numpy.isnan(numbers), text,
+                       formatted.astype(numpy.unicode_))
 
-    self.parent = parent
-    self.sizer = wx.BoxSizer(wx.VERTICAL)
+  def get_arrays(self):
+    '''
+    Return a dictionary of arrays for saving, see from_arrays
+    '''
+    return {'keys': numpy.array(self.keys, dtype=numpy.unicode_),
+            'values': self.values,
+            'range_labels': numpy.array(self.range_labels,
+                                        dtype=numpy.unicode_)}
 
-    self.graph = Figure((1.0, 1.0), facecolor='white', dpi=100,
-                        tight_layout=True)
-    self.canvas = FigureCanvasWxAgg(parent, -1, self.graph)
+  @classmethod
+  def from_arrays(cls, arrays):
+    '''
+    Create the columns from a dictionary of arrays made by get_arrays
+    '''
+    columns = cls.__new__(cls)
+    columns.keys = arrays['keys'].tolist()
+    columns.rows = dict([ (key, i) for i, key in enumerate(columns.keys) ])
+    columns.values = arrays['values']
+    columns.valid = ~numpy.isnan(columns.values)
+    columns.range_labels = arrays['range_labels'].tolist()
+    columns.n = len(columns.range_labels)
+    columns.x = numpy.arange(columns.n, dtype=numpy.float64)
+    return columns
+
+  def get_series(self, key):
+    '''
+    Return the x and y values of a column for plotting
+    '''
+    i = self.rows[key]
+    valid = self.valid[i]
+    return self.x[valid], self.values[i][valid]
+
+class table_two_plot(object):
+  '''
+  Plots of Table 2 in a matplotlib Figure, without any wx widgets
+  The lines, legends and labels are created once and updated in place. The
+  limits of the logarithmic plots are whole decades, so they rarely change
+  between tags.
+  If animated is True, the lines are not drawn with the rest of the figure
+  and have to be drawn separately (see TableTwoWidgets)
+  Other tags can be drawn over the plots for comparison (see set_overlays)
+  '''
+  overlay_styles = ('--', ':', '-.')
+
+  def __init__(self, graph, animated=False):
+
+    self.graph = graph
+    self.animated = animated
 
     self.top_plot = self.graph.add_subplot(311)
-    self.top_plot.plot([0, 1], [0, 1], 'w')
     self.top_plot.set_xticklabels(list(), visible=False)
+    self.top_plot.set_yscale('log')
 
     self.middle_plot = self.graph.add_subplot(312)
-    self.middle_plot.plot([0, 1], [0, 1], 'w')
     self.middle_plot.set_xticklabels(list(), visible=False)
+    self.middle_plot.set_yscale('log')
 
     self.bottom_plot = self.graph.add_subplot(313)
-    self.bottom_plot.plot([0,1 ], [0, 1], 'w')
-    self.bottom_plot.set_xlabel('Resolution Range ($\AA$)')
+    self.bottom_plot.set_xlabel(r'Resolution Range ($\AA$)')
+    self.bottom_plot.set_ylim((0, 110))
     self.bottom_plot.invert_xaxis()
 
-    self.sizer.Add(self.canvas, 1, wx.ALL|wx.EXPAND, 3)
+    # one line per column of Table 2
+    self.plots = [self.top_plot, self.middle_plot, self.bottom_plot]
+    self.lines = dict()
+    for plot, series in zip(self.plots, table_two_series):
+      for key, label in series:
+        self.lines[key] = plot.plot([], [], label=label,
+                                    animated=animated)[0]
+
+    # create legends
+    self.top_plot.legend()
+    self.middle_plot.legend()
+    self.bottom_plot.legend(loc=7)
+
+    self.range_labels = None
+    self.y_limits = [None, None]    # limits of top and middle plots
+
+    # name -> [columns, style, lines] for each overlaid tag
+    self.overlays = collections.OrderedDict()
 
-  def update_values(self, t2):
+  def update_values(self, columns):
     '''
-    Given a parsed JSON object, t2, update the values in the graphs
+    Given a table_two_columns, update the values in the plots
+    Returns True if the labels or the limits changed, so that the whole
+    figure has to be drawn again
     '''
 
-    # clear old plots
-    self.top_plot.clear()
-    self.top_plot = self.graph.add_subplot(311)
-    self.middle_plot.clear()
-    self.middle_plot = self.graph.add_subplot(312)
-    self.bottom_plot.clear()
-    self.bottom_plot = self.graph.add_subplot(313)
+    # labels for resolution range
+    layout_changed = False
+    range_labels = columns.range_labels
+    if (range_labels != self.range_labels):
+      layout_changed = True
+      self.range_labels = range_labels
+      n = len(range_labels)
+      x = range(n)     # equally spaced x values
+      blank_labels = ['' for i in xrange(n)]
+      for plot in self.plots:
+        plot.set_xticks(x)
+        plot.set_xlim((x[0], x[-1]))
+      self.top_plot.set_xticklabels(blank_labels, visible=False)
+      self.middle_plot.set_xticklabels(blank_labels, visible=False)
+      self.bottom_plot.set_xticklabels(range_labels, rotation=35)
 
-    # create labels for resolution range
-    x_high = t2['Resolution High']
-    x_low = t2['Resolution Low']
-    if (x_low[0] == 'inf'):
-      x_low[0] = r'$\infty$'
-    n = min(len(x_high), len(x_low))
-    x = range(n)     # equally spaced x values
-    range_labels = ['' for i in xrange(n)]
-    blank_labels = ['' for i in xrange(n)]
-    label_format = '%.2f'
-    for i in xrange(n):
+    # update plots
+    for key, line in self.lines.iteritems():
+      line.set_data(*columns.get_series(key))
+
+    # rescale the logarithmic plots to whole decades
+    for i, series in enumerate(table_two_series[:2]):
+      y = numpy.concatenate([ self.lines[key].get_ydata()
+                              for key, label in series ])
+      y = y[y > 0]
+      limits = None
+      if (len(y) > 0):
+        limits = (10.0**numpy.floor(numpy.log10(y.min())),
+                  10.0**numpy.ceil(numpy.log10(y.max())))
+        if (limits[0] == limits[1]):
+          limits = (limits[0], 10.0*limits[1])
+      if (limits != self.y_limits[i]):
+        self.y_limits[i] = limits
+        if (limits is not None):
+          self.plots[i].set_ylim(limits)
+        layout_changed = True
+
+    return layout_changed
+
+  def set_overlays(self, overlays):
+    '''
+    Given a list of (name, table_two_columns, line style), draw other tags
+    over the plots with the colors of the current tag
+    Only the lines of overlays that are added, removed or changed are
+    updated, the other lines are kept. Overlays are not in the legends and do
+    not change the labels or the limits of the plots.
+    Returns True if any line changed
+    '''
+    changed = False
+    names = set([ name for name, columns, style in overlays ])
+    for name in self.overlays.keys():
+      if (name not in names):
+        for line in self.overlays.pop(name)[2].itervalues():
+          line.remove()
+        changed = True
+
+    for name, columns, style in overlays:
+      overlay = self.overlays.get(name)
+      if (overlay is None):
+        lines = dict()
+        for key, line in self.lines.iteritems():
+          lines[key] = line.axes.plot(
+            [], [], color=line.get_color(), linestyle=style, alpha=0.6,
+            label='_nolegend_', animated=self.animated)[0]
+        overlay = [None, style, lines]
+        self.overlays[name] = overlay
+      elif (overlay[1] != style):
+        overlay[1] = style
+        for line in overlay[2].itervalues():
+          line.set_linestyle(style)
+        changed = True
+      if (overlay[0] is not columns):
+        overlay[0] = columns
+        for key, line in overlay[2].iteritems():
+          line.set_data(*columns.get_series(key))
+        changed = True
+
+    return changed
+
+# matplotlib shares fonts between figures, so figures are not drawn at the
+# same time on different threads, blits do not draw text and do not need it
+draw_lock = threading.Lock()
+
+locked_canvas_class = None
+
+def locked_canvas(parent, graph):
+  '''
+  Return a FigureCanvasWxAgg for graph that holds draw_lock whenever it
+  draws, including the draws for paint and resize events of wx
+  The class is created on first use, so that the wx backend of matplotlib
+  is only imported by the GUI
+  '''
+  global locked_canvas_class
+  if (locked_canvas_class is None):
+    from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg
+    class LockedCanvas(FigureCanvasWxAgg):
+      def draw(self, *args, **kwargs):
+        with draw_lock:
+          FigureCanvasWxAgg.draw(self, *args, **kwargs)
+    locked_canvas_class = LockedCanvas
+  return locked_canvas_class(parent, -1, graph)
+
+def bitmap_from_rgb(width, height, data):
+  '''
+  Create a wx.Bitmap from RGB data (wxPython Phoenix and classic)
+  '''
+  if (hasattr(wx.Bitmap, 'FromBuffer')):
+    return wx.Bitmap.FromBuffer(width, height, data)
+  return wx.BitmapFromBuffer(width, height, data)
+
+class render_worker(threading.Thread):
+  '''
+  Background thread that draws Table 2 into an off-screen Agg buffer
+  Only the latest request is drawn, requests that are replaced before they
+  are started are dropped. After each drawing,
+  callback(generation, width, height, data) is called on the wx main loop
+  with the RGB data.
+  '''
+  def __init__(self, callback, dpi=100):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    threading.Thread.__init__(self, name='render_worker')
+    self.daemon = True
+    self.callback = callback
+    self.dpi = dpi
+    self.graph = Figure((1.0, 1.0), facecolor='white', dpi=dpi,
+                        tight_layout=True)
+    self.canvas = FigureCanvasAgg(self.graph)
+    self.plot = table_two_plot(self.graph)
+    self.lock = threading.Lock()
+    self.requested = threading.Event()
+    self.stop_event = threading.Event()
+    self.pending = None
+
+  def request(self, generation, columns, width, height, overlays=()):
+    '''
+    Ask for columns to be drawn in a width x height (pixels) image, overlays
+    is passed to table_two_plot.set_overlays
+    Can be called from any thread
+    '''
+    with self.lock:
+      self.pending = (generation, columns, width, height, overlays)
+      self.requested.set()
+
+  def run(self):
+    while (not self.stop_event.is_set()):
+      self.requested.wait(0.5)
+      with self.lock:
+        pending = self.pending
+        self.pending = None
+        self.requested.clear()
+      if ( (pending is None) or self.stop_event.is_set() ):
+        continue
+      generation, columns, width, height, overlays = pending
       try:
-        x_low_f = float(x_low[i])
-        x_low[i] = label_format % (round(x_low_f, 2))
+        self.graph.set_size_inches(float(width)/self.dpi,
+                                   float(height)/self.dpi)
+        self.plot.update_values(columns)
+        self.plot.set_overlays(overlays)
+        with draw_lock:
+          self.canvas.draw()
+        data = self.canvas.tostring_rgb()
+        width, height = self.canvas.get_width_height()
       except Exception:
-        pass
+        traceback.print_exc()
+        continue
+      if (not self.stop_event.is_set()):
+        wx.CallAfter(self.callback, generation, width, height, data)
+
+  def stop(self):
+    self.stop_event.set()
+    self.requested.set()
+
+class TableTwoWidgets(object):
+  '''
+  Container for widgets for Table 2 data
+  The figure is only drawn again when the table_two_plot layout changes,
+  otherwise the lines are drawn over a saved copy of the rest of the figure
+  If threaded is True, the figure is drawn by a render_worker and the main
+  thread only shows the finished bitmap
+  Other tags can be overlaid for comparison, each one keeps its line style
+  while it is shown
+  '''
+  def __init__(self, parent, threaded=False):
+    from matplotlib.figure import Figure
+
+    self.parent = parent
+    self.sizer = wx.BoxSizer(wx.VERTICAL)
+
+    self.graph = None
+    self.renderer = None
+    self.plot = None
+    self.overlays = list()      # (name, columns, style)
+    if (threaded):
+      # the render_worker draws the figure, the panel only shows the bitmap
+      self.canvas = wx.Panel(parent)
+      self.canvas.Bind(wx.EVT_PAINT, self.OnPaint)
+      self.canvas.Bind(wx.EVT_SIZE, self.OnSize)
+      self.bitmap = None
+      self.generation = 0
+      self.columns = None
+      self.renderer = render_worker(self.OnRendered)
+      self.renderer.start()
+    else:
+      self.graph = Figure((1.0, 1.0), facecolor='white', dpi=100,
+                          tight_layout=True)
+      self.canvas = locked_canvas(parent, self.graph)
+      self.canvas.mpl_connect('draw_event', self.OnDraw)
+      self.plot = table_two_plot(self.graph, animated=True)
+
+    # figure without the lines and the legends, saved after each full draw
+    self.background = None
+    self.legends = list()
+
+    self.n_draws = 0        # whole figure
+    self.n_blits = 0        # only the lines
+    self.n_dropped = 0      # older drawings from the render_worker
+
+    self.sizer.Add(self.canvas, 1, wx.ALL|wx.EXPAND, 3)
+
+  def update_values(self, t2, columns=None):
+    '''
+    Given a parsed JSON object, t2, update the values in the graphs
+    columns is the table_two_columns for t2, it is created if it is not
+    provided
+    '''
+    if (columns is None):
+      columns = table_two_columns(t2)
+
+    if (self.renderer is not None):
+      self.columns = columns
+      self.request_render()
+    elif (self.plot.update_values(columns)):
+      self.draw()
+    else:
+      self.refresh_lines()
+
+  def set_overlays(self, overlays):
+    '''
+    Given a list of (name, table_two_columns), show the other tags over the
+    current tag
+    Only the lines of tags that are added or removed are changed, so this
+    does not draw the whole figure again
+    '''
+    styles = dict([ (name, style) for name, columns, style in self.overlays ])
+    styles = dict([ (name, styles[name]) for name, columns in overlays
+                    if (name in styles) ])
+    free = [ style for style in table_two_plot.overlay_styles
+             if (style not in styles.values()) ]
+    for i, (name, columns) in enumerate(overlays):
+      if (name not in styles):
+        if (len(free) > 0):
+          styles[name] = free.pop(0)
+        else:
+          styles[name] = table_two_plot.overlay_styles[
+            i % len(table_two_plot.overlay_styles)]
+    self.overlays = [ (name, columns, styles[name])
+                      for name, columns in overlays ]
+
+    if (self.renderer is not None):
+      self.request_render()
+    elif (self.plot.set_overlays(self.overlays)):
+      self.refresh_lines()
+
+  def get_overlays(self):
+    '''
+    Return a list of (name, line style) of the overlaid tags
+    '''
+    return [ (name, style) for name, columns, style in self.overlays ]
+
+  def refresh_lines(self):
+    '''
+    Draw only the lines over the saved figure
+    '''
+    if (self.background is None):
+      self.draw()
+      return
+    self.n_blits += 1
+    self.canvas.restore_region(self.background)
+    self.draw_lines()
+
+  def draw(self):
+    self.n_draws += 1
+    self.canvas.draw()
+
+  def draw_lines(self):
+    '''
+    Draw the lines over the figure and the legends over the lines
+    '''
+    for plot in self.plot.plots:
+      for line in plot.get_lines():
+        plot.draw_artist(line)
+    for legend in self.legends:
+      self.canvas.restore_region(legend)
+    self.canvas.blit(self.graph.bbox)
+
+  def request_render(self):
+    '''
+    Ask the render_worker to draw the current columns at the canvas size,
+    results for older requests are not shown
+    '''
+    if (self.columns is None):
+      return
+    self.generation += 1
+    width, height = self.canvas.GetSize()
+    self.renderer.request(self.generation, self.columns, width, height,
+                          self.overlays)
+
+  def OnRendered(self, generation, width, height, data):
+    '''
+    Called on the main loop when the render_worker finished drawing
+    '''
+    if (generation != self.generation):
+      self.n_dropped += 1
+      return
+    self.n_draws += 1
+    self.bitmap = bitmap_from_rgb(width, height, data)
+    self.canvas.Refresh(False)
+
+  def OnPaint(self, event):
+    '''
+    Show the latest drawing of the render_worker
+    '''
+    dc = wx.PaintDC(self.canvas)
+    if (self.bitmap is not None):
+      dc.DrawBitmap(self.bitmap, 0, 0)
+
+  def OnSize(self, event):
+    '''
+    Ask the render_worker for a drawing at the new size
+    '''
+    event.Skip()
+    self.request_render()
+
+  def OnDraw(self, event=None):
+    '''
+    Called after the figure of the canvas is drawn (e.g. after a resize),
+    the figure without the lines is saved and the lines are drawn
+    '''
+    self.background = self.canvas.copy_from_bbox(self.graph.bbox)
+    self.legends = [ self.canvas.copy_from_bbox(
+                       plot.get_legend().get_window_extent())
+                     for plot in self.plot.plots ]
+    self.draw_lines()
+
+  def stop(self):
+    if (self.renderer is not None):
+      self.renderer.stop()
+
+# =============================================================================
+# headless rendering of Table 2 into image files, without wx
+def read_table_two(path):
+  '''
+  Return the table_two_columns of a JSON file, the sidecar is used if it is
+  newer than the JSON file
+  '''
+  sidecar = sidecar_path(path)
+  try:
+    if (os.path.getmtime(sidecar) > os.path.getmtime(path)):
+      return read_sidecar(sidecar)['Table 2 columns']
+  except (IOError, OSError, ValueError, KeyError):
+    pass
+  return table_two_columns(load_json_keys(path, ('Table 2',))['Table 2'])
+
+# figure, canvas and table_two_plot of a worker process of render_batch
+batch_renderer = None
+
+def init_batch_renderer(width, height, dpi):
+  '''
+  Create the figure once for each worker process, it is reused for every tag
+  '''
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  from matplotlib.figure import Figure
+  global batch_renderer
+  graph = Figure((float(width)/dpi, float(height)/dpi), facecolor='white',
+                 dpi=dpi)
+  batch_renderer = (graph, FigureCanvasAgg(graph), table_two_plot(graph))
+
+def render_tag(paths):
+  '''
+  Draw Table 2 of a JSON file into an image file, paths is (JSON path, image
+  path), the format is given by the extension of the image
+  The image is written under a temporary name and renamed, so that an
+  interrupted run does not leave an image that looks up to date
+  Returns None, or the error message if the image could not be made
+  '''
+  json_path, image_path = paths
+  graph, canvas, plot = batch_renderer
+  temporary = '%s.%d.tmp' % (image_path, os.getpid())
+  try:
+    if (plot.update_values(read_table_two(json_path))):
+      graph.tight_layout()     # only when the labels or limits change
+    directory = os.path.dirname(image_path)
+    if (not os.path.isdir(directory)):
       try:
-        x_high_f = float(x_high[i])
-        x_high[i] = label_format % (round(x_high_f, 2))
-      except Exception:
-        pass
-      range_labels[i] = x_low[i] + ' - ' + x_high[i]
-    self.top_plot.set_xticks(x[:n])
-    self.top_plot.set_xticklabels(blank_labels, visible=False)
-    self.top_plot.set_yscale('log')
-    self.middle_plot.set_xticks(x[:n])
-    self.middle_plot.set_xticklabels(blank_labels, visible=False)
-    self.middle_plot.set_yscale('log')
-    self.bottom_plot.set_xticks(x[:n])
-    self.bottom_plot.set_xticklabels(range_labels, rotation=35)
-    self.bottom_plot.set_xlim((x[0], x[-1]))
-    self.bottom_plot.set_xlabel(r'Resolution Range ($\AA$)')
-    self.bottom_plot.set_ylim((0, 110))
+        os.makedirs(directory)
+      except OSError as e:
+        if (e.errno != errno.EEXIST):
+          raise
+    canvas.print_figure(temporary, dpi=graph.dpi, facecolor='white',
+                        format=os.path.splitext(image_path)[1][1:])
+    os.rename(temporary, image_path)
+  except Exception as e:
+    try:
+      os.remove(temporary)
+    except OSError:
+      pass
+    return '%s: %s' % (e.__class__.__name__, e)
+  return None
+
+def render_batch(files, pool, output_dir, image_format='png'):
+  '''
+  Draw Table 2 of every tag of a file_manager into
+  <output_dir>/<tag>.<image_format>, images that are newer than their JSON
+  file are skipped
+  Tags in different roots can have the same name, so with more than one root
+  the images are in <output_dir>/<root name>/, the root name is numbered if
+  roots have the same name
+  The tags are drawn by pool, a multiprocessing Pool whose workers were
+  started with init_batch_renderer
+  Returns the number of images that were drawn, skipped and failed
+  '''
+  root_names = dict()
+  if (len(files.roots) > 1):
+    names = [ os.path.basename(root) for root in files.roots ]
+    for i, (root, name) in enumerate(zip(files.roots, names)):
+      if (names.count(name) > 1):
+        name = '%s_%d' % (name, i + 1)
+      root_names[root] = name
+
+  files.update_unique_files()
+  tasks = list()
+  skipped = 0
+  for i in xrange(len(files.index)):
+    tag = files.index[i]
+    json_path = os.path.join(tag, os.path.basename(tag)) + '.' + \
+                files.file_extensions[0]
+    name = files.get_label(tag)
+    root = files.get_root(tag)
+    if (root in root_names):
+      name = os.path.join(root_names[root], name)
+    image_path = os.path.join(output_dir, name + '.' + image_format)
+    try:
+      if (os.path.getmtime(image_path) > os.path.getmtime(json_path)):
+        skipped += 1
+        continue
+    except OSError:
+      pass
+    tasks.append((json_path, image_path))
+
+  drawn = 0
+  failed = 0
+  chunksize = max(1, min(16, len(tasks) // (4 * multiprocessing.cpu_count())))
+  results = pool.imap(render_tag, tasks, chunksize)
+  for (json_path, image_path), error in zip(tasks, results):
+    if (error is None):
+      drawn += 1
+    else:
+      failed += 1
+      print('Could not draw %s (%s)' % (image_path, error))
+  return drawn, skipped, failed
 
-    # update plots
-    for key, label in [('No. Measurements', r'N$_{measurements}$'),
-                       ('No. Lattices', r'N$_{lattices}$'),
-                       ('No. Unique reflections', r'N$_{reflections}$')]:
-      x_plot, y_plot = self.convert_values(x, t2[key])
-      self.top_plot.plot(x_plot, y_plot, label=label)
-
-    for key, label in [('<Multiplicity>', r'$\langle$Multiplicity$\rangle$'),
-                       ('<I/sigI>', r'$\langle$I/sigI$\rangle$')]:
-      x_plot, y_plot = self.convert_values(x, t2[key])
-      self.middle_plot.plot(x_plot, y_plot, label=label)
-
-    for key, label in [('Completeness', 'Completeness'),
-                       ('CC1/2', r'CC$_{1/2}$'),
-                       ('CCiso', r'CC$_{iso}$'),
-                       ('Rsplit',r'R$_{split}$')]:
-      x_plot, y_plot = self.convert_values(x, t2[key])
-      self.bottom_plot.plot(x_plot, y_plot, label=label)
+# =============================================================================
+class TrendWidgets(object):
+  '''
+  Container for widgets for the trends of Table 1 values across tags
+  New points are plotted as new artists, so the points that are already
+  shown are not plotted again, the artists for a metric are merged once
+  there are more than max_artists
+  The points are animated artists that are blitted over the figure saved
+  after the last full draw, the whole figure is only drawn again when new
+  points are outside of the axes limits, the time axis is then extended by
+  x_margin of its range for the points that follow
+  '''
+  plots = (('CC1/2', 'Rsplit'), ('Rwork', 'Rfree'), ('I/sigI',),
+           ('Completeness',))
+  max_artists = 16
+  x_margin = 0.25
 
-    # create legends
-    self.top_plot.legend()
-    self.middle_plot.legend()
-    self.bottom_plot.legend(loc=7)
+  def __init__(self, parent, trends):
+    from matplotlib.figure import Figure
+    from matplotlib.lines import Line2D
+
+    self.parent = parent
+    self.trends = trends
+    self.sizer = wx.BoxSizer(wx.VERTICAL)
+
+    self.graph = Figure((1.0, 1.0), facecolor='white', dpi=100,
+                        tight_layout=True)
+    self.canvas = locked_canvas(parent, self.graph)
+    self.canvas.mpl_connect('draw_event', self.OnDraw)
+
+    self.axes = dict()      # metric -> plot
+    self.colors = dict()    # metric -> color
+    self.artists = dict()   # metric -> list of artists
+    color = 0
+    for i, names in enumerate(self.plots):
+      plot = self.graph.add_subplot(len(self.plots), 1, i + 1)
+      plot.xaxis_date()
+      if (i < len(self.plots) - 1):
+        plot.set_xticklabels(list(), visible=False)
+      handles = list()
+      for name in names:
+        self.axes[name] = plot
+        self.colors[name] = 'C%d' % color
+        self.artists[name] = list()
+        handles.append(Line2D([], [], marker='.', linestyle='',
+                              color=self.colors[name]))
+        color += 1
+      plot.legend(handles, names, loc=2)
+      plot.set_autoscale_on(False)
+    self.graph.autofmt_xdate()
+    self.n_shown = 0
+    self.revision = 0
+
+    # figure without the points and the legends, saved after each full draw
+    self.background = None
+    self.legends = list()
+
+    self.n_draws = 0
+    self.n_blits = 0
+
+    self.sizer.Add(self.canvas, 1, wx.ALL|wx.EXPAND, 3)
+
+  def update_values(self):
+    '''
+    Plot the points added to the trends since the last update
+    '''
+    from matplotlib.dates import epoch2num
+    if ( (len(self.trends) == self.n_shown) and
+         (self.trends.revision == self.revision) ):
+      return
+    if (self.trends.revision != self.revision):
+      # stored values were replaced, plot everything again
+      for artists in self.artists.values():
+        for artist in artists:
+          artist.remove()
+        del artists[:]
+      self.n_shown = 0
+    revision, times, values = self.trends.get_arrays(self.n_shown)
+    self.revision = revision
+    self.n_shown += len(times)
+    x = epoch2num(times)
+    redraw = False
+    for name, plot in self.axes.iteritems():
+      artists = self.artists[name]
+      artists.extend(plot.plot(x, values[name], '.', color=self.colors[name],
+                               animated=True))
+      if (len(artists) > self.max_artists):
+        x_all = numpy.concatenate([ artist.get_xdata() for artist in artists ])
+        y_all = numpy.concatenate([ artist.get_ydata() for artist in artists ])
+        for artist in artists[1:]:
+          artist.remove()
+        artists[0].set_data(x_all, y_all)
+        del artists[1:]
+      if (not self.is_inside(plot, x, values[name])):
+        redraw = True
+    if (redraw or (self.background is None)):
+      self.rescale()
+      self.draw()
+    else:
+      self.refresh_points()
 
+  def is_inside(self, plot, x, y):
+    '''
+    Check if the points are within the current limits of plot
+    '''
+    shown = numpy.isfinite(y)
+    if (not shown.any()):
+      return True
+    x = x[shown]
+    y = y[shown]
+    x_min, x_max = plot.get_xlim()
+    y_min, y_max = plot.get_ylim()
+    return ( (x.min() >= x_min) and (x.max() <= x_max) and
+             (y.min() >= y_min) and (y.max() <= y_max) )
+
+  def rescale(self):
+    '''
+    Fit the limits to all points, with room for later points on the time
+    axis, the limits are kept until the next rescale
+    '''
+    for names in self.plots:
+      plot = self.axes[names[0]]
+      plot.relim()
+      if (not numpy.isfinite(plot.dataLim.get_points()).all()):
+        continue    # no values yet
+      plot.set_autoscale_on(True)
+      plot.autoscale_view()
+      x_min, x_max = plot.get_xlim()
+      plot.set_xlim(x_min, x_max + self.x_margin*(x_max - x_min))
+      plot.set_autoscale_on(False)
+
+  def refresh_points(self):
+    '''
+    Draw only the points over the saved figure
+    '''
+    self.n_blits += 1
+    self.canvas.restore_region(self.background)
+    self.draw_points()
+
+  def draw(self):
+    self.n_draws += 1
     self.canvas.draw()
 
-  def convert_values(self, x, y):
-    '''
-    Given the values from Table 2, return a list of x and a list of y for
-    plotting
-    '''
-    x_plot = list()
-    y_plot = list()
-    n = min(len(x), len(y))
-    for i in xrange(n):
-      if ( isinstance(y[i], str) or isinstance(y[i], unicode) ):
-        try:
-          y_new = float(y[i])
-          y[i] = y_new
-          x_plot.append(x[i])
-          y_plot.append(y[i])
-        except Exception:
-          continue
-      else:
-        x_plot.append(x[i])
-        y_plot.append(y[i])
-    return x_plot, y_plot
+  def draw_points(self):
+    '''
+    Draw the points over the figure and the legends over the points
+    '''
+    for name, plot in self.axes.iteritems():
+      for artist in self.artists[name]:
+        plot.draw_artist(artist)
+    for legend in self.legends:
+      self.canvas.restore_region(legend)
+    self.canvas.blit(self.graph.bbox)
+
+  def OnDraw(self, event=None):
+    '''
+    Called after the figure of the canvas is drawn (e.g. after a resize),
+    the figure without the points is saved and the points are drawn
+    '''
+    self.background = self.canvas.copy_from_bbox(self.graph.bbox)
+    self.legends = [ self.canvas.copy_from_bbox(
+                       self.axes[names[0]].get_legend().get_window_extent())
+                     for names in self.plots ]
+    self.draw_points()
+
+# =============================================================================
+class startup_profile(object):
+  '''
+  Time spent in each phase of starting the GUI, starting at start
+  The phases are printed once by report if enabled is True
+  '''
+  def __init__(self, start, enabled=False):
+    self.start = start
+    self.last = start
+    self.enabled = enabled
+    self.phases = list()
+    self.reported = False
+
+  def mark(self, phase):
+    '''
+    End a phase that started at the previous mark
+    '''
+    if (self.reported):
+      return
+    now = time.time()
+    self.phases.append((phase, now - self.last))
+    self.last = now
+
+  def report(self):
+    if (self.reported):
+      return
+    self.reported = True
+    if (not self.enabled):
+      return
+    print('Startup profile (seconds)')
+    for phase, seconds in self.phases:
+      print('  %-28s %7.3f' % (phase, seconds))
+    print('  %-28s %7.3f' % ('total', self.last - self.start))
 
 # =============================================================================
-class MonitorFrame(wx.Frame):
+class MonitorFrame(frame_base):
   '''
   Main window for GUI
+  Only the widgets without plots are created before the window is shown,
+  the catalog, the plots, Coot and the background threads are started by
+  finish_startup once the window is on the screen
   '''
-  def __init__(self, parent, args):
+  def __init__(self, parent, args, profile=None):
+    from wxtbx import bitmaps
+    self.args = args
+    self.profile = profile
+    if (self.profile is None):
+      self.profile = startup_profile(time.time())
     size = (args.width, args.height)
     wx.Frame.__init__(self, parent, title='Status Monitor', size=size)
     main_sizer = wx.BoxSizer(wx.VERTICAL)
     self.Bind(wx.EVT_CLOSE, self.OnClose)
 
-    # timer
-    self.interval = args.interval * 1000  # interval in milliseconds
+    # timer, restarted as a one-shot timer after each update
+    self.scheduler = update_scheduler(args.interval,
+                                      max_interval=args.max_interval)
     self.timer = wx.Timer(self)
-    self.timer.Start(self.interval)
     self.Bind(wx.EVT_TIMER, self.UpdateView, self.timer)
     self.auto_update = True
+    self.status_bar = self.CreateStatusBar(3)
 
-    # track current tag
+    # widgets are not updated while the window is not visible, only the
+    # latest values are shown when it becomes visible again
+    self.pending_tables = None
+    self.trends_dirty = False
+    self.n_deferred = 0
+    self.Bind(wx.EVT_ICONIZE, self.OnVisibility)
+    self.Bind(wx.EVT_SHOW, self.OnVisibility)
+
+    # track current tag and refinement cycle
     self.current_prefix = None
 
+    # tags shown over Table 2, the tags chosen with the Compare button and
+    # the overlay_count tags before the current tag
+    self.pinned = list()
+    self.overlay_count = args.overlay
+
+    # created by finish_startup
+    self.files = None
+    self.t2 = None
+    self.trends = None
+    self.coot = None
+    self.scanner = None
+    self.prefetcher = None
+    self.closing = False
+
     # section for progress
-    progress_panel = wx.Panel(self, style=wx.SUNKEN_BORDER)
+    self.progress_panel = progress_panel = wx.Panel(
+      self, style=wx.SUNKEN_BORDER)
     progress_sizer = wx.BoxSizer(wx.VERTICAL)
-    self.files = file_manager(os.path.abspath(args.directory))
-    self.files.update_unique_files()
+    self.directories = directories = [ os.path.abspath(directory)
+                                       for directory in args.directory ]
 
     # subsection of file information
-    file_info_sizer = wx.FlexGridSizer(rows=2, cols=2)
+    self.file_info_sizer = wx.FlexGridSizer(rows=3, cols=2)
     directory_label = wx.StaticText(progress_panel, label='Directory: ')
     directory_text = wx.StaticText(
-      progress_panel, label=os.path.abspath(args.directory))
+      progress_panel, label='\n'.join(directories))
     bold_font = directory_label.GetFont()
     bold_font.SetWeight(wx.FONTWEIGHT_BOLD)
     directory_label.SetFont(bold_font)
     file_label = wx.StaticText(progress_panel, label='Tag: ')
     file_label.SetFont(bold_font)
-    file_text = self.files.get_current()
-    if (file_text is None):
-      file_text = ''
-    self.file_text = wx.StaticText(progress_panel, label=file_text)
-    file_info_sizer.Add(directory_label, 0, wx.ALIGN_RIGHT, 0)
-    file_info_sizer.Add(directory_text, 0, wx.EXPAND|wx.ALIGN_LEFT, 0)
-    file_info_sizer.Add(file_label, 0, wx.ALIGN_RIGHT, 0)
-    file_info_sizer.Add(self.file_text, 0, wx.EXPAND|wx.ALIGN_LEFT, 0)
-
-    # subsection for Table 1
-    data_sizer = wx.BoxSizer(wx.HORIZONTAL)
+    self.file_text = wx.StaticText(progress_panel, label='')
+    self.file_info_sizer.Add(directory_label, 0, wx.ALIGN_RIGHT, 0)
+    self.file_info_sizer.Add(directory_text, 0, wx.EXPAND|wx.ALIGN_LEFT, 0)
+    self.file_info_sizer.Add(file_label, 0, wx.ALIGN_RIGHT, 0)
+    self.file_info_sizer.Add(self.file_text, 0, wx.EXPAND|wx.ALIGN_LEFT, 0)
+    overlay_label = wx.StaticText(progress_panel, label='Compare: ')
+    overlay_label.SetFont(bold_font)
+    self.overlay_text = wx.StaticText(progress_panel, label='')
+    self.file_info_sizer.Add(overlay_label, 0, wx.ALIGN_RIGHT, 0)
+    self.file_info_sizer.Add(self.overlay_text, 0, wx.EXPAND|wx.ALIGN_LEFT, 0)
+
+    # subsection for Table 1, the plots are added by finish_startup
+    self.data_sizer = data_sizer = wx.BoxSizer(wx.HORIZONTAL)
     self.t1 = TableOneWidgets(progress_panel)
 
-    # subsection for Table 2 graph
-    self.t2 = TableTwoWidgets(progress_panel)
-
     data_sizer.Add(self.t1.sizer, 0, wx.ALL, 3)
     data_sizer.Add(
       wx.StaticLine(progress_panel, size=(20, 20), style=wx.LI_VERTICAL),
       0, wx.ALIGN_CENTER_VERTICAL|wx.TOP|wx.BOTTOM|wx.EXPAND, 25)
-    data_sizer.Add(self.t2.sizer, 1, wx.EXPAND|wx.ALL, 0)
 
     # layout data panel
-    progress_sizer.Add(file_info_sizer, 0, wx.ALL|wx.EXPAND, 3)
+    progress_sizer.Add(self.file_info_sizer, 0, wx.ALL|wx.EXPAND, 3)
     progress_sizer.Add(
       wx.StaticLine(progress_panel, size=(args.width-50, 4),
                     style=wx.LI_HORIZONTAL),
@@ -482,10 +3450,18 @@ class MonitorFrame(wx.Frame):
     self.auto_button.SetBitmap(
       bitmap=bitmaps.fetch_icon_bitmap('actions','stop', scale=self.scale))
     self.auto_button.Bind(wx.EVT_BUTTON, self.OnToggleAuto)
+    self.auto_button.Enable(False)
+
+    # toggle comparison with the current tag
+    self.compare_button = wx.ToggleButton(button_panel, label='Compare')
+    self.compare_button.SetToolTip(
+      wx.ToolTip('Keep the Table 2 plots of this tag for comparison'))
+    self.compare_button.Bind(wx.EVT_TOGGLEBUTTON, self.OnToggleCompare)
 
     # layout buttons
     button_sizer.Add(self.prev_button, 0, wx.ALL, 1)
     button_sizer.Add(self.next_button, 0, wx.ALL, 1)
+    button_sizer.Add(self.compare_button, 0, wx.ALL, 3)
     button_sizer.AddStretchSpacer()
     button_sizer.Add(self.auto_button, 0, wx.ALL, 3)
     button_panel.SetSizer(button_sizer)
@@ -495,8 +3471,50 @@ class MonitorFrame(wx.Frame):
     main_sizer.Add(button_panel, 0, wx.ALL|wx.EXPAND, 3)
     self.SetSizerAndFit(main_sizer)
     self.SetMinSize(size)
+    self.profile.mark('frame')
+
+    # runs once the main loop has started
+    wx.CallAfter(self.finish_startup)
+
+  def finish_startup(self):
+    '''
+    Start everything that is not needed to show the window
+    '''
+    if (self.closing):
+      return
+    args = self.args
+    self.Update()
+    self.profile.mark('first paint')
+
+    # open the catalog
+    catalog = None
+    if (not args.no_catalog):
+      catalog = args.catalog
+      if (catalog is None):
+        catalog = default_catalog_path(self.directories[0])
+    self.files = file_manager(self.directories, catalog=catalog,
+                              depth=args.depth,
+                              max_workers=args.scan_threads,
+                              completion=args.completion, marker=args.marker,
+                              cache_size=args.cache_size*1024*1024,
+                              sidecars=args.sidecars)
+    self.profile.mark('catalog')
+
+    # subsection for Table 2 graph
+    self.t2 = TableTwoWidgets(self.progress_panel,
+                              threaded=args.threaded_render)
+    self.data_sizer.Add(self.t2.sizer, 1, wx.EXPAND|wx.ALL, 0)
+
+    # subsection for trends of Table 1 values across tags
+    if (not args.no_trends):
+      self.trends = TrendWidgets(self.progress_panel, self.files.trends)
+      self.data_sizer.Add(self.trends.sizer, 1, wx.EXPAND|wx.ALL, 0)
+    self.Layout()
+    self.profile.mark('plots')
 
     # start Coot
+    import libtbx.load_env
+    from libtbx import xmlrpc_utils
     guidemo_path = os.environ.get('GUI_DEMO_PREFIX','')
     coot_path = os.environ.get('COOT_PREFIX','')
     if coot_path:
@@ -509,25 +3527,129 @@ class MonitorFrame(wx.Frame):
     coot_cmd = [os.path.join(coot_path, coot_cmd)]
     self.coot = xmlrpc_utils.external_program_server(
       command_args=coot_cmd, program_id='Coot', timeout=250)
-
-  def update_view(self, prefix):
-    if ( (prefix is not None) and (prefix != self.current_prefix) ):
+    self.profile.mark('Coot')
+
+    # scan directories in the background, starting now
+    trends_callback = None
+    if (self.trends is not None):
+      trends_callback = self.OnTrends
+    self.scanner = scan_worker(self.files, self.OnScanResults,
+                               trends_callback=trends_callback)
+    self.scanner.start()
+    self.prefetcher = None
+    if (args.prefetch > 0):
+      self.prefetcher = prefetch_worker(self.files, radius=args.prefetch)
+      self.prefetcher.start()
+    if (args.watch):
+      self.files.start_watching(callback=self.OnDirectoryEvent)
+    self.scheduler.tick()
+    self.scanner.request()
+    self.timer.Start(self.scheduler.schedule(), wx.TIMER_ONE_SHOT)
+    self.auto_button.Enable(True)
+    self.profile.mark('background threads')
+
+  def update_view(self, prefix, identities=None):
+    '''
+    Show the statistics, model and maps for prefix
+    The model and maps are reloaded when a newer refinement cycle of the
+    current prefix becomes available
+    Only known refinement cycles are used, the background scan checks the
+    directory of a newly shown tag
+    Files of the current prefix that are rewritten are reloaded, the others
+    are kept, identities of the files come from the background scan
+    Returns True if anything was reloaded
+    '''
+    if (prefix is None):
+      return False
+    tag = os.path.dirname(prefix)
+    cycle = self.files.get_cycle(tag)
+    changed = self.files.changed_artifacts(prefix, cycle, identities)
+    if (prefix != self.current_prefix):
       self.current_prefix = prefix
-      self.file_text.SetLabel(os.path.basename(prefix))
-      f = open(prefix + '.json', 'r')
-      table = json.load(f)
-      f.close()
-      self.t1.update_values(table['Table 1'])
-      self.t2.update_values(table['Table 2'])
+      self.scanner.request([tag])
+      width = self.file_text.GetSize().width
+      self.file_text.SetLabel(self.files.get_label(tag))
+      if (self.file_text.GetSize().width != width):
+        self.file_info_sizer.Layout()
+      self.compare_button.SetValue(prefix in self.pinned)
+
+    if ('json' in changed):
+      table = self.files.get_tables(prefix)
+      self.status_bar.SetStatusText(self.files.tables.get_status(), 1)
+      self.files.store_statistics(tag, table['Table 1'])
+      if (self.pending_tables is not None):
+        self.n_deferred += 1
+      self.pending_tables = table
+      if (self.is_visible()):
+        self.show_tables()
+
+    if (cycle is not None):
+      # one request for the model and the maps, empty names are kept as shown
+      # (add anom_maps=False to use auto_load_maps)
+      model_file, mtz_file = self.files.get_cycle_files(prefix, cycle)
+      if ('model' not in changed):
+        model_file = ''
+      if ('maps' not in changed):
+        mtz_file = ''
+      if ( (model_file or mtz_file) and self.coot.is_alive() ):
+        self.coot.load_tag(model_file, mtz_file)
+    return (len(changed) > 0)
+
+  def is_visible(self):
+    return (self.IsShownOnScreen() and (not self.IsIconized()))
+
+  def show_tables(self):
+    '''
+    Show the latest statistics in Table 1 and Table 2
+    '''
+    table = self.pending_tables
+    if (table is None):
+      return
+    self.pending_tables = None
+    resized = self.t1.update_values(table['Table 1'])
+    self.t2.update_values(table['Table 2'], table['Table 2 columns'])
+    self.update_overlays()
+    if (resized):
       self.Layout()
+    self.status_bar.SetStatusText(self.get_draw_status(), 2)
 
-      model_file = prefix + '_001.pdb'
-      mtz_file = prefix + '_001.mtz'
-      if (self.coot.is_alive()):
-        self.coot.update_model(model_file)
-        self.coot.close_maps()
-        #self.coot.auto_load_maps(mtz_file)
-        self.coot.auto_load_anom_maps(mtz_file)
+  def update_overlays(self):
+    '''
+    Show the pinned tags and the tags before the current tag over Table 2
+    The statistics are usually already in the cache of the file_manager
+    '''
+    prefixes = list(self.pinned)
+    if (self.overlay_count > 0):
+      prefixes.extend(self.files.get_earlier(self.overlay_count))
+    overlays = list()
+    labels = dict()
+    for prefix in prefixes:
+      if ( (prefix == self.current_prefix) or (prefix in labels) ):
+        continue
+      try:
+        columns = self.files.get_tables(prefix)['Table 2 columns']
+      except (IOError, OSError, ValueError, KeyError):
+        continue
+      overlays.append((prefix, columns))
+      labels[prefix] = self.files.get_label(os.path.dirname(prefix))
+    self.t2.set_overlays(overlays)
+
+    width = self.overlay_text.GetSize().width
+    self.overlay_text.SetLabel('   '.join(
+      [ '%s (%s)' % (labels[prefix], style)
+        for prefix, style in self.t2.get_overlays() ]))
+    if (self.overlay_text.GetSize().width != width):
+      self.file_info_sizer.Layout()
+
+  def get_draw_status(self):
+    draws = self.t2.n_draws
+    blits = self.t2.n_blits
+    if (self.trends is not None):
+      draws += self.trends.n_draws
+      blits += self.trends.n_blits
+    return 'Draws: %d   Blits: %d   Relabels: %d (%d unchanged)   ' \
+      'Deferred: %d' % (draws, blits, self.t1.n_relabels,
+                        self.t1.n_unchanged, self.n_deferred)
 
   def check_next_prev_buttons(self):
     self.prev_button.Enable(True)
@@ -544,6 +3666,7 @@ class MonitorFrame(wx.Frame):
     Start/Stop automatic updating
     Next/Prev buttons only work if autoupdate is off
     '''
+    from wxtbx import bitmaps
     # stop monitoring
     if (self.auto_update):
       self.auto_button.SetLabel('Start')
@@ -551,6 +3674,7 @@ class MonitorFrame(wx.Frame):
         bitmap=bitmaps.fetch_icon_bitmap('actions','runit', scale=self.scale))
       self.check_next_prev_buttons()
       self.auto_update = False
+      self.prefetch()
     # start monitoring
     else:
       self.auto_button.SetLabel('Stop')
@@ -562,14 +3686,106 @@ class MonitorFrame(wx.Frame):
       prefix = self.files.get_latest(full_path=True)
       self.update_view(prefix)
 
+  def OnToggleCompare(self, event=None):
+    '''
+    Add or remove the current tag from the tags shown over Table 2, it is
+    shown once another tag is the current tag
+    '''
+    prefix = self.current_prefix
+    if (prefix is None):
+      self.compare_button.SetValue(False)
+      return
+    if (prefix in self.pinned):
+      self.pinned.remove(prefix)
+    else:
+      self.pinned.append(prefix)
+    self.compare_button.SetValue(prefix in self.pinned)
+    self.update_overlays()
+
   def UpdateView(self, event=None):
     '''
-    Update tracked files and view if set to automatically update
+    Ask for tracked files to be updated, the view is updated in OnScanResults
+    if set to automatically update
+    Ticks are skipped while the previous update is still running
     '''
-    self.files.update_unique_files()
-    if (self.auto_update):
-      prefix = self.files.get_latest(full_path=True)
-      self.update_view(prefix)
+    if (self.scheduler.tick()):
+      tags = None
+      if (self.current_prefix is not None):
+        tags = [os.path.dirname(self.current_prefix)]
+      self.scanner.request(tags)
+    self.timer.Start(self.scheduler.schedule(), wx.TIMER_ONE_SHOT)
+    self.status_bar.SetStatusText(self.scheduler.get_status())
+
+  def OnScanResults(self, new_tags, cycles, identities):
+    '''
+    Called on the main loop after each background scan
+    The next tick is scheduled after the view has been updated, so the time
+    spent here counts towards the cost of the update
+    A tag that cannot be shown is reported and the updates continue
+    '''
+    if (self.closing):
+      return
+    changed = (len(new_tags) > 0)
+    try:
+      if (self.auto_update):
+        prefix = self.files.get_latest(full_path=True)
+        if (prefix is None):
+          # already showing the latest tag, check for a new refinement cycle
+          prefix = self.current_prefix
+      else:
+        if (len(new_tags) > 0):
+          self.check_next_prev_buttons()
+        prefix = self.current_prefix
+      changed = self.update_view(prefix, identities) or changed
+    except Exception:
+      traceback.print_exc()
+    finally:
+      # keep updating quickly while files are being written
+      self.scheduler.finish(changed or self.files.is_writing())
+      self.timer.Start(self.scheduler.schedule(), wx.TIMER_ONE_SHOT)
+    self.status_bar.SetStatusText(self.scheduler.get_status())
+    if (not self.profile.reported):
+      self.profile.mark('first scan')
+      self.profile.report()
+
+  def OnTrends(self):
+    '''
+    Called on the main loop when new tags were added to the trends
+    '''
+    if (self.closing):
+      return
+    if (self.is_visible()):
+      self.trends.update_values()
+    else:
+      if (self.trends_dirty):
+        self.n_deferred += 1
+      self.trends_dirty = True
+
+  def OnVisibility(self, event=None):
+    '''
+    Show deferred updates when the window is shown or restored
+    '''
+    if (event is not None):
+      event.Skip()
+    wx.CallAfter(self.show_deferred)
+
+  def show_deferred(self):
+    if ( self.closing or (not self.is_visible()) ):
+      return
+    self.show_tables()
+    if (self.trends_dirty):
+      self.trends_dirty = False
+      self.trends.update_values()
+
+  def OnDirectoryEvent(self):
+    '''
+    Called from the directory watcher thread when new events arrive
+    '''
+    prefix = self.current_prefix
+    tags = None
+    if (prefix is not None):
+      tags = [os.path.dirname(prefix)]
+    self.scanner.request(tags)
 
   def GetPrev(self, event=None):
     '''
@@ -577,6 +3793,7 @@ class MonitorFrame(wx.Frame):
     '''
     prefix = self.files.get_previous(full_path=True)
     self.check_next_prev_buttons()
+    self.prefetch()
     self.update_view(prefix)
 
   def GetNext(self, event=None):
@@ -585,10 +3802,33 @@ class MonitorFrame(wx.Frame):
     '''
     prefix = self.files.get_next(full_path=True)
     self.check_next_prev_buttons()
+    self.prefetch()
     self.update_view(prefix)
 
+  def prefetch(self):
+    '''
+    Read the tags around the current position in the background
+    '''
+    if (self.prefetcher is not None):
+      self.prefetcher.request()
+
   def OnClose(self, event=None):
-    if (self.coot.is_alive()):
+    self.closing = True
+    self.timer.Stop()
+    if (self.scanner is not None):    # finish_startup has run
+      self.scanner.stop()
+      self.t2.stop()
+      if (self.prefetcher is not None):
+        self.prefetcher.stop()
+      self.files.stop_watching()
+      self.scanner.join(1.0)
+      busy = self.scanner.is_alive()
+      if (self.prefetcher is not None):
+        self.prefetcher.join(1.0)
+        busy = busy or self.prefetcher.is_alive()
+      if (not busy):
+        self.files.close()
+    if ( (self.coot is not None) and self.coot.is_alive() ):
       self.coot.quit()
     self.Destroy()
 
@@ -598,17 +3838,109 @@ if (__name__ == '__main__'):
   # comamnd-line arguments for customization
   parser = argparse.ArgumentParser(description='GUI for monitoring progress')
   parser.add_argument('-y', '--height', type=int, default=600,
-                      help='height of window')
+                      help='height of window (or of images with --batch)')
   parser.add_argument('-x', '--width', type=int, default=800,
-                      help='width of window')
+                      help='width of window (or of images with --batch)')
   parser.add_argument('-i', '--interval', type=int, default=5,
                       help='time between updates (seconds)')
-  parser.add_argument('-d', '--directory', type=unicode, default='.',
-                      help='directory to monitor')
+  parser.add_argument('--max-interval', type=int, default=None,
+                      help='longest time between updates while nothing '
+                      'changes (seconds, default: 8 times the interval)')
+  parser.add_argument('-d', '--directory', type=unicode, nargs='+',
+                      default=['.'], help='directories to monitor')
+  parser.add_argument('--depth', type=int, default=0,
+                      help='levels of subdirectories to search for tags')
+  parser.add_argument('--scan-threads', type=int, default=4,
+                      help='number of threads for scanning directories')
+  parser.add_argument('-w', '--watch', action='store_true', default=False,
+                      help='use inotify to detect new files instead of '
+                      'listing the directory at every update (Linux only)')
+  parser.add_argument('--catalog', type=unicode, default=None,
+                      help='file for storing tags between runs (default: '
+                      '.<directory name>.gui_demo.sqlite next to the first '
+                      'directory)')
+  parser.add_argument('--no-catalog', action='store_true', default=False,
+                      help='do not store tags between runs')
+  parser.add_argument('--completion', choices=completion_checker.modes,
+                      default='stable',
+                      help='how to tell that files are completely written: '
+                      'size and time stop changing (stable), a marker file '
+                      'is newer (marker) or files are renamed into place '
+                      '(rename)')
+  parser.add_argument('--marker', type=unicode, default='{tag}.done',
+                      help='marker file in the tag directory for '
+                      '--completion=marker, {tag} is replaced by the tag')
+  parser.add_argument('--prefetch', type=int, default=2,
+                      help='number of tags on either side of the current tag '
+                      'to read in the background while stepping through '
+                      'tags (0 to disable)')
+  parser.add_argument('--no-trends', action='store_true', default=False,
+                      help='do not read Table 1 of every tag to plot trends')
+  parser.add_argument('--sidecars', action='store_true', default=False,
+                      help='write binary copies of the statistics '
+                      '(<tag>.monitor.npz) next to the JSON files to make '
+                      'reading them faster')
+  parser.add_argument('--threaded-render', action='store_true',
+                      default=False,
+                      help='draw the Table 2 plots on a background thread')
+  parser.add_argument('--overlay', type=int, default=0,
+                      help='number of tags before the current tag to show '
+                      'over the Table 2 plots for comparison')
+  parser.add_argument('--cache-size', type=int, default=64,
+                      help='memory for statistics of recently shown tags (MB)')
+  parser.add_argument('--batch', type=unicode, default=None,
+                      metavar='OUTPUT_DIR',
+                      help='draw the Table 2 plots of every tag into images in '
+                      'OUTPUT_DIR (in a subdirectory per directory if there '
+                      'are several) and exit without opening a window, images '
+                      'are width x height pixels')
+  parser.add_argument('--format', choices=('png', 'svg'), default='png',
+                      help='image format for --batch')
+  parser.add_argument('--processes', type=int, default=None,
+                      help='number of processes for --batch (default: number '
+                      'of CPUs)')
+  parser.add_argument('--profile-startup', action='store_true', default=False,
+                      help='print the time spent in each phase of starting '
+                      'the GUI, up to the first scan')
   args = parser.parse_args()
 
+  # draw images without the GUI
+  if (args.batch is not None):
+    matplotlib.use('Agg')
+    # start the processes before any threads are started for scanning
+    pool = multiprocessing.pool.Pool(
+      args.processes, initializer=init_batch_renderer,
+      initargs=(args.width, args.height, 100))
+    catalog = None
+    if (not args.no_catalog):
+      catalog = args.catalog
+      if (catalog is None):
+        catalog = default_catalog_path(os.path.abspath(args.directory[0]))
+    files = file_manager(args.directory, catalog=catalog, depth=args.depth,
+                         max_workers=args.scan_threads,
+                         completion=args.completion, marker=args.marker)
+    start = time.time()
+    try:
+      drawn, skipped, failed = render_batch(
+        files, pool, os.path.abspath(args.batch), image_format=args.format)
+    finally:
+      pool.close()
+      pool.join()
+      files.close()
+    print('Drew %d images in %.1f s, %d up to date, %d failed' %
+          (drawn, time.time() - start, skipped, failed))
+    sys.exit(1 if (failed > 0) else 0)
+
   # run GUI
+  if (wx is None):
+    parser.error('wxPython is required for the GUI, only --batch works '
+                 'without it')
+  matplotlib.use('WXAgg')
+  profile = startup_profile(import_start, enabled=args.profile_startup)
+  profile.mark('imports')
   app = wx.App(False)
-  frame = MonitorFrame(None, args)
+  profile.mark('wx.App')
+  frame = MonitorFrame(None, args, profile=profile)
   frame.Show()
+  profile.mark('show')
   app.MainLoop()